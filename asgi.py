@@ -0,0 +1,373 @@
+"""ASGI entry point: the same Flask routes (/api/*, /webhook, /web) on an event loop.
+
+    uvicorn asgi:app --workers 4 --host 0.0.0.0 --port $PORT
+
+Connections live on the event loop, so thousands of idle or slow Mini App
+sessions cost a socket each instead of a gunicorn worker. The Flask view of a
+request (and all its SQLite work) runs on a bounded thread pool: GET/HEAD on
+ASGI_THREADS threads, everything else on ASGI_WRITE_THREADS (default: two per
+shard, at least 4) - SQLite takes one writer per file anyway, and more threads
+only end up sleeping in its busy handler. Once ASGI_MAX_PENDING requests are
+queued the app answers 503 instead of piling up. Bot API calls go through an async HTTP
+client (httpx when installed, urllib on a few side threads otherwise) and
+sendMessage does not wait for Telegram at all. POSTs that only wait on the Bot
+API (TG_PATHS: createInvoiceLink) run on the GET pool, so a slow Telegram never
+holds one of the few write threads. /api/events (SSE) is served on the loop
+itself, so an open stream costs a socket and no thread. The per_user_admission
+routes are admitted on the loop: a duplicate of a running (user, route) request
+awaits that request's response there instead of queueing for a write thread.
+"""
+import io
+import os
+import sys
+import json
+import asyncio
+import threading
+import urllib.parse
+import concurrent.futures
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import server  # noqa: E402
+
+try:
+    import httpx
+except ImportError:  # optional, urllib in a thread pool is used otherwise
+    httpx = None
+
+ASGI_THREADS = max(1, server.as_int(os.environ.get("ASGI_THREADS"), 32))
+ASGI_WRITE_THREADS = max(1, server.as_int(os.environ.get("ASGI_WRITE_THREADS"), max(4, server.DB_SHARDS * 2)))
+ASGI_MAX_PENDING = max(0, server.as_int(os.environ.get("ASGI_MAX_PENDING"), ASGI_THREADS * 16))
+ASGI_MAX_BODY = server.as_int(os.environ.get("ASGI_MAX_BODY"), 1 << 20)
+
+OVERLOADED = b'{"ok":false,"error":"overloaded"}'
+BUSY = b'{"ok":false,"error":"busy"}'
+TOO_LARGE = b'{"ok":false,"error":"body_too_large"}'
+# no SQLite writes, just a blocking Bot API round trip: keep them off the write pool
+TG_PATHS = {"/api/create_invoice"}
+
+
+class AsyncTelegram:
+    """server.TG_TRANSPORT that performs the HTTP calls on the event loop."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.tasks = set()
+        self.client = httpx.AsyncClient(timeout=20) if httpx else None
+        self.pool = None if self.client else concurrent.futures.ThreadPoolExecutor(4, thread_name_prefix="tg")
+
+    async def post(self, url, data):
+        if self.client is None:
+            return await self.loop.run_in_executor(self.pool, server.tg_post, url, data)
+        try:
+            resp = await self.client.post(url, content=data, headers={"Content-Type": "application/json"})
+            return resp.json()
+        except Exception as e:
+            return {"ok": False, "description": str(e)}
+
+    def call(self, url, data):
+        # called from a request thread, never from the loop itself
+        return asyncio.run_coroutine_threadsafe(self.post(url, data), self.loop).result()
+
+    def send(self, url, data):
+        self.loop.call_soon_threadsafe(self._spawn, url, data)
+
+    def _spawn(self, url, data):
+        task = self.loop.create_task(self.post(url, data))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def close(self):
+        if self.tasks:
+            await asyncio.wait(self.tasks, timeout=10)
+        if self.client is not None:
+            await self.client.aclose()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+
+
+class AsyncSubscriber(server.Subscriber):
+    """server.Subscriber whose reader is a coroutine on `loop`."""
+
+    def __init__(self, user_id, loop):
+        super().__init__(user_id)
+        self.loop = loop
+        self.ready = asyncio.Event()
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+    async def aget(self, timeout):
+        self.ready.clear()
+        ev = self.take()
+        if ev is None:
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            ev = self.take()
+        return ev
+
+
+def admission_user(body: bytes) -> int:
+    """The JSON user_id per_user_admission keys on, 0 if there is none."""
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        return 0
+    return server.as_int(data.get("user_id"), 0) if isinstance(data, dict) else 0
+
+
+def build_environ(scope, body: bytes, disconnected: threading.Event) -> dict:
+    root = scope.get("root_path", "")
+    path = scope["path"]
+    if root and path.startswith(root):
+        path = path[len(root):]
+    host, port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": root.encode("utf-8").decode("latin-1"),
+        "PATH_INFO": path.encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": host,
+        "SERVER_PORT": str(port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        "asgi.disconnected": disconnected,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = scope["client"][0], str(scope["client"][1])
+    for name, value in scope.get("headers", []):
+        key = name.decode("latin-1").upper().replace("-", "_")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = "HTTP_" + key
+        value = value.decode("latin-1")
+        environ[key] = f"{environ[key]},{value}" if key in environ and key.startswith("HTTP_") else value
+    return environ
+
+
+class FlaskASGI:
+    def __init__(self, wsgi_app, threads=ASGI_THREADS, write_threads=ASGI_WRITE_THREADS,
+                 max_pending=ASGI_MAX_PENDING):
+        self.wsgi_app = wsgi_app
+        self.threads = threads
+        self.write_threads = write_threads
+        self.max_inflight = threads + write_threads + max_pending
+        self.inflight = 0
+        self.executor = self.write_executor = None
+        self.telegram = None
+        # path -> per_user_admission name, admitted here instead of in the view
+        self.admission = {rule.rule: wsgi_app.view_functions[rule.endpoint].admission
+                          for rule in wsgi_app.url_map.iter_rules()
+                          if hasattr(wsgi_app.view_functions[rule.endpoint], "admission")}
+        self.flights = {}  # (user_id, name) -> Future of the running request's result
+
+    async def startup(self):
+        loop = asyncio.get_running_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.threads, thread_name_prefix="flask")
+        self.write_executor = concurrent.futures.ThreadPoolExecutor(self.write_threads, thread_name_prefix="flask-w")
+        self.telegram = AsyncTelegram(loop)
+        server.TG_TRANSPORT = self.telegram
+        server.EVENTS_STREAM = True  # /api/events is served by self.events, on the loop
+        server.start_recovery()
+
+    async def shutdown(self):
+        server.TG_TRANSPORT = None
+        if self.telegram is not None:
+            await self.telegram.close()
+        for pool in (self.executor, self.write_executor):
+            if pool is not None:
+                pool.shutdown(wait=True)
+        self.executor = self.write_executor = self.telegram = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+        if self.executor is None:  # server without lifespan support
+            await self.startup()
+        if scope["path"] == "/api/events" and scope["method"] == "GET":
+            return await self.events(scope, receive, send)
+
+        body = bytearray()
+        while True:
+            msg = await receive()
+            if msg["type"] == "http.disconnect":
+                return
+            body += msg.get("body", b"")
+            if len(body) > ASGI_MAX_BODY:
+                return await self.reply(send, 413, TOO_LARGE)
+            if not msg.get("more_body"):
+                break
+
+        name = self.admission.get(scope["path"]) if scope["method"] == "POST" else None
+        user_id = admission_user(body) if name else 0
+        if user_id:
+            result = await self.admit(user_id, name, scope, bytes(body), receive, send)
+        else:
+            result = await self.dispatch(scope, bytes(body), receive, send)
+        if result is not None and result[0] is not None:
+            start, payload = result
+            await send(start)
+            await send({"type": "http.response.body", "body": payload})
+
+    async def admit(self, user_id, name, scope, body, receive, send):
+        """server.per_user_admission on the loop; the view then only takes its lease."""
+        key = (user_id, name)
+        flight = self.flights.get(key)
+        if flight is not None:
+            server._admit_count(name, "coalesced")
+            try:
+                result = await asyncio.wait_for(asyncio.shield(flight), server.ADMIT_WAIT)
+            except asyncio.TimeoutError:
+                result = None
+            if result is None or result[0] is None:
+                await self.reply(send, 429, BUSY, [(b"retry-after", b"1")])
+                return None
+            start, payload = result
+            return dict(start, headers=start["headers"] + [(b"x-coalesced", b"1")]), payload
+
+        with server._admit_lock:
+            wait = server._take_token(key)
+        if wait:
+            server._admit_count(name, "rejected")
+            body = json.dumps({"ok": False, "error": "rate_limited", "retry_after": round(wait, 1)}).encode()
+            await self.reply(send, 429, body, [(b"retry-after", str(max(1, int(wait + 0.999))).encode())])
+            return None
+        flight = self.flights[key] = asyncio.get_running_loop().create_future()
+        result = None
+        try:
+            result = await self.dispatch(scope, body, receive, send, admitted=True)
+            return result
+        finally:
+            del self.flights[key]
+            flight.set_result(result)
+
+    async def dispatch(self, scope, body, receive, send, admitted=False):
+        """Runs the view on a pool: (start, payload), (None, None) if it streamed, None if refused."""
+        if self.inflight >= self.max_inflight:
+            await self.reply(send, 503, OVERLOADED, [(b"retry-after", b"1")])
+            return None
+        disconnected = threading.Event()
+        watcher = asyncio.ensure_future(self.watch_disconnect(receive, disconnected))
+        self.inflight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            environ = build_environ(scope, body, disconnected)
+            environ["asgi.admitted"] = admitted
+            reads = scope["method"] in ("GET", "HEAD") or scope["path"] in TG_PATHS
+            pool = self.executor if reads else self.write_executor
+            return await loop.run_in_executor(pool, self.run_wsgi, environ, loop, send)
+        finally:
+            self.inflight -= 1
+            watcher.cancel()
+
+    def run_wsgi(self, environ, loop, send):
+        """Runs on the pool. Buffers the response, except text/event-stream which is pushed chunk by chunk."""
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            status, headers = started
+            start = {
+                "type": "http.response.start",
+                "status": int(status[:3]),
+                "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+            }
+            if not any(k.lower() == "content-type" and v.startswith("text/event-stream") for k, v in headers):
+                return start, b"".join(result)
+
+            def push(message):
+                asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+            push(start)
+            for chunk in result:
+                if environ["asgi.disconnected"].is_set():
+                    break
+                if chunk:
+                    push({"type": "http.response.body", "body": chunk, "more_body": True})
+            push({"type": "http.response.body", "body": b""})
+            return None, None
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+    async def events(self, scope, receive, send):
+        """Same stream as server.api_events, driven by the loop."""
+        args = urllib.parse.parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        user_id = server.as_int((args.get("user_id") or ["0"])[0])
+        if not user_id:
+            return await self.reply(send, 400, b'{"ok":false,"error":"user_id required"}')
+        headers = dict(scope.get("headers", []))
+        last_id = server.as_int(headers.get(b"last-event-id", b"").decode("latin-1") or (args.get("last_id") or ["0"])[0])
+
+        loop = asyncio.get_running_loop()
+        sub = server.BROKER.subscribe(AsyncSubscriber(user_id, loop))
+        gone = threading.Event()
+        watcher = asyncio.ensure_future(self.watch_disconnect(receive, gone, sub.wake))
+        try:
+            prelude, seen = await loop.run_in_executor(self.executor, server.sse_prelude, user_id, last_id)
+            await send({"type": "http.response.start", "status": 200,
+                        "headers": [(b"content-type", b"text/event-stream; charset=utf-8"),
+                                    (b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")]})
+            await send({"type": "http.response.body", "body": prelude, "more_body": True})
+            deadline = loop.time() + server.EVENTS_MAX_AGE
+            while loop.time() < deadline and not gone.is_set():
+                ev = await sub.aget(server.EVENTS_HEARTBEAT)
+                if ev is server.RESYNC:
+                    await send({"type": "http.response.body", "body": server.SSE_RESYNC, "more_body": True})
+                    break
+                if ev is None:
+                    chunk = server.SSE_PING
+                elif ev[0] in seen:
+                    continue
+                else:
+                    chunk = server.sse_event(ev)
+                if not gone.is_set():
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            if not gone.is_set():
+                await send({"type": "http.response.body", "body": b""})
+        except OSError:
+            pass  # client went away mid-send
+        finally:
+            server.BROKER.unsubscribe(sub)
+            watcher.cancel()
+
+    @staticmethod
+    async def watch_disconnect(receive, disconnected, wake=None):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        disconnected.set()
+        if wake is not None:
+            wake()
+
+    @staticmethod
+    async def reply(send, status, body, headers=()):
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"application/json"),
+                                (b"content-length", str(len(body)).encode())] + list(headers)})
+        await send({"type": "http.response.body", "body": body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            msg = await receive()
+            if msg["type"] == "lifespan.startup":
+                await self.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif msg["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+app = FlaskASGI(server.app)
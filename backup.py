@@ -0,0 +1,192 @@
+"""Online backup of DB_PATH and its shard files while the app keeps serving.
+
+    python backup.py --out backups/                          # one snapshot of every file
+    python backup.py --out backups/ --gzip --pages 256 --sleep 0.01
+    python backup.py --out backups/ --every 3600 --keep 24   # background loop
+
+Each run writes backups/<YYYYmmdd-HHMMSS>/<file>[.gz]. Files are copied with
+SQLite's online backup API, --pages pages per step with --sleep seconds
+between steps. Every source holds a read transaction for the whole run: with
+WAL that pins one snapshot per file (taken together at the start), so the copy
+is consistent and never restarts, and writers are not blocked - checkpoints
+just can't pass the snapshot, so the -wal files grow until the run ends.
+A probe times BEGIN IMMEDIATE on the sources before and during the copy to
+show what the backup costs writers.
+
+Restore with the app stopped: put the files in place (gunzip first), delete
+stale -wal/-shm next to them, then `python shards.py recover`.
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import server  # noqa: E402
+
+
+class LockProbe(threading.Thread):
+    """Times BEGIN IMMEDIATE/ROLLBACK on `paths` every `interval` seconds."""
+
+    def __init__(self, paths, interval=0.05):
+        super().__init__(daemon=True)
+        self.paths = paths
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        conns = [sqlite3.connect(p, isolation_level=None, timeout=30) for p in self.paths]
+        try:
+            while not self.stopped.wait(self.interval):
+                for conn in conns:
+                    t0 = time.perf_counter()
+                    conn.execute("BEGIN IMMEDIATE")
+                    self.samples.append(time.perf_counter() - t0)
+                    conn.execute("ROLLBACK")
+        finally:
+            for conn in conns:
+                conn.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return summarize_ms(self.samples)
+
+
+def summarize_ms(samples):
+    if not samples:
+        return {"n": 0}
+    s = sorted(samples)
+    return {"n": len(s), "p50_ms": round(s[len(s) // 2] * 1000, 3),
+            "p99_ms": round(s[min(len(s) - 1, int(len(s) * 0.99))] * 1000, 3), "max_ms": round(s[-1] * 1000, 3)}
+
+
+def wal_size(path):
+    return os.path.getsize(path + "-wal") if os.path.exists(path + "-wal") else 0
+
+
+def pin(path):
+    """Read-only connection holding a read transaction (= a WAL snapshot) on `path`."""
+    src = sqlite3.connect(f"file:{path}?mode=ro", uri=True, isolation_level=None)
+    src.execute("BEGIN")
+    src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+    return src
+
+
+def copy_file(src, path, dest, pages=256, sleep=0.01, verify=False):
+    part = dest + ".part"
+    dst = sqlite3.connect(part)
+    steps = [0]
+
+    def progress(status, remaining, total):
+        steps[0] += 1
+        if remaining and sleep:
+            time.sleep(sleep)  # let the app's own reads/checkpoints through between steps
+
+    wal_before = wal_size(path)
+    t0 = time.perf_counter()
+    src.backup(dst, pages=pages, progress=progress)
+    copy_s = time.perf_counter() - t0
+    size = dst.execute("PRAGMA page_count").fetchone()[0] * dst.execute("PRAGMA page_size").fetchone()[0]
+    if verify:
+        check = dst.execute("PRAGMA quick_check").fetchone()[0]
+        if check != "ok":
+            dst.close()
+            raise SystemExit(f"{dest}: quick_check failed: {check}")
+    dst.close()
+
+    os.replace(part, dest)
+    return {"file": os.path.basename(dest), "bytes": size, "steps": steps[0], "seconds": round(copy_s, 3),
+            "mb_per_s": round(size / 1e6 / copy_s, 1) if copy_s else None,
+            "wal_growth_bytes": max(0, wal_size(path) - wal_before)}
+
+
+def gzip_file(dest, stats):
+    t0 = time.perf_counter()
+    with open(dest, "rb") as f, gzip.open(dest + ".gz", "wb", compresslevel=6) as out:
+        shutil.copyfileobj(f, out, 1 << 20)
+    os.remove(dest)
+    stats["gzip_bytes"] = os.path.getsize(dest + ".gz")
+    stats["gzip_seconds"] = round(time.perf_counter() - t0, 3)
+
+
+def backup_all(out, pages=256, sleep=0.01, compress=False, verify=False, probe=1.0, log=print):
+    paths = sorted(set(server.shard_paths()) | {server.DB_PATH})
+    target = base = os.path.join(out, time.strftime("%Y%m%d-%H%M%S"))
+    n = 0
+    while os.path.exists(target) or os.path.exists(target + ".part"):
+        n += 1
+        target = f"{base}-{n}"
+    os.makedirs(target + ".part")
+    report = {"dir": target, "files": []}
+    if probe:
+        idle = LockProbe(paths)
+        idle.start()
+        time.sleep(probe)
+        report["lock_before"] = idle.stop()
+        busy = LockProbe(paths)
+        busy.start()
+
+    # all snapshots first, so the files are (nearly) from the same instant
+    sources = [(path, pin(path)) for path in paths]
+    t0 = time.perf_counter()
+    try:
+        for path, src in sources:
+            stats = copy_file(src, path, os.path.join(target + ".part", os.path.basename(path)),
+                              pages=pages, sleep=sleep, verify=verify)
+            src.close()  # release this file's snapshot, its WAL can be checkpointed again
+            report["files"].append(stats)
+    finally:
+        for _, src in sources:
+            src.close()
+        if probe:
+            report["lock_during"] = busy.stop()
+    report["seconds"] = round(time.perf_counter() - t0, 3)
+    # compressing is off the snapshot: no source is held open while it runs
+    for stats in report["files"]:
+        if compress:
+            gzip_file(os.path.join(target + ".part", stats["file"]), stats)
+        log(json.dumps(stats))
+    os.replace(target + ".part", target)
+    report["bytes"] = sum(f["bytes"] for f in report["files"])
+    return report
+
+
+def prune(out, keep):
+    runs = sorted(d for d in os.listdir(out) if os.path.isdir(os.path.join(out, d)) and not d.endswith(".part"))
+    for d in runs[:-keep] if keep else []:
+        shutil.rmtree(os.path.join(out, d), ignore_errors=True)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--out", required=True, help="backups directory")
+    ap.add_argument("--pages", type=int, default=256, help="pages copied per step (-1 = all at once)")
+    ap.add_argument("--sleep", type=float, default=0.01, help="seconds between steps")
+    ap.add_argument("--gzip", action="store_true", help="store <file>.gz")
+    ap.add_argument("--verify", action="store_true", help="PRAGMA quick_check on each copy")
+    ap.add_argument("--probe", type=float, default=1.0, help="seconds of write-lock probing before the copy, 0 = off")
+    ap.add_argument("--every", type=float, default=0, help="repeat every N seconds (background task)")
+    ap.add_argument("--keep", type=int, default=0, help="keep only the newest N backups")
+    args = ap.parse_args(argv)
+
+    while True:
+        started = time.monotonic()
+        report = backup_all(os.path.abspath(args.out), pages=args.pages, sleep=args.sleep, compress=args.gzip,
+                            verify=args.verify, probe=args.probe)
+        print(json.dumps({k: v for k, v in report.items() if k != "files"}), flush=True)
+        if args.keep:
+            prune(os.path.abspath(args.out), args.keep)
+        if not args.every:
+            break
+        time.sleep(max(0.0, args.every - (time.monotonic() - started)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,705 @@
+"""Load test / benchmark harness for server.py.
+
+Boots the app against a throwaway synthetic game.db (see gen_data.py) and drives every /api flow,
+reporting throughput and p50/p95/p99 latency per flow as JSON.
+
+    python bench.py --users 2000 --requests 300 --out bench.json
+    python bench.py --mode gunicorn --workers 4 --concurrency 16
+    python bench.py --mode compare --workers 4 --concurrency 64   # gunicorn vs uvicorn asgi:app
+    python bench.py --baseline bench_prev.json --out bench.json
+    python bench.py --boot                                        # worker import time, migrate.py
+    python bench.py --mode gunicorn --backup --baseline b.json    # p99 with backup.py running
+"""
+import os
+import sys
+import json
+import time
+import queue
+import random
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import platform
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# =========================
+# Workdir / fixtures
+# =========================
+def make_workdir():
+    """Temp dir that looks like the repo root: code symlinked, data copied."""
+    workdir = tempfile.mkdtemp(prefix="fs_bench_")
+    for name in os.listdir(ROOT):
+        if name.endswith(".py") or name in ("web", "static"):
+            os.symlink(os.path.join(ROOT, name), os.path.join(workdir, name))
+
+    # players.json / clubs.json in the repo have no ids; the API looks
+    # everything up by id, so give each entry a stable one.
+    for name in ("players.json", "clubs.json"):
+        with open(os.path.join(ROOT, name), "r", encoding="utf-8") as f:
+            items = json.load(f)
+        for i, it in enumerate(items):
+            it.setdefault("id", i + 1)
+        with open(os.path.join(workdir, name), "w", encoding="utf-8") as f:
+            json.dump(items, f, ensure_ascii=False)
+    return workdir
+
+
+def add_bench_fixture(server, n_fixture, n_players):
+    """Rich users the write flows can hammer without running out of coins/packs/cards."""
+    for path in server.shard_paths():
+        conn = sqlite3.connect(path)
+        with conn:
+            conn.execute("UPDATE users SET coins=?, pack_credits=?, last_daily=0 WHERE user_id<=?",
+                         (10 ** 12, 10 ** 9, n_fixture))
+            conn.executemany(
+                "INSERT OR REPLACE INTO inventory(user_id, player_id, qty) VALUES(?,?,?)",
+                ((uid, (uid % n_players) + 1, 10 ** 6) for uid in range(1, n_fixture + 1)
+                 if server.shard_paths()[server.shard_index(uid)] == path))
+        conn.close()
+
+# =========================
+# Transports
+# =========================
+class TestClientTransport:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path):
+        r = self.client.get(path)
+        return r.status_code, r.get_json(silent=True) or {}
+
+    def post(self, path, body):
+        r = self.client.post(path, json=body)
+        return r.status_code, r.get_json(silent=True) or {}
+
+
+class HttpTransport:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+
+    def _call(self, req):
+        try:
+            with urllib.request.urlopen(req, timeout=30) as resp:
+                return resp.status, json.loads(resp.read() or b"{}")
+        except urllib.error.HTTPError as e:
+            try:
+                return e.code, json.loads(e.read() or b"{}")
+            except ValueError:
+                return e.code, {}
+        except OSError:  # timeout / reset: counted as an error, status 599 like most load tools
+            return 599, {}
+
+    def get(self, path):
+        return self._call(urllib.request.Request(self.base_url + path))
+
+    def post(self, path, body):
+        data = json.dumps(body).encode("utf-8")
+        return self._call(urllib.request.Request(self.base_url + path, data=data,
+                                                 headers={"Content-Type": "application/json"}))
+
+# =========================
+# Flows
+# =========================
+class Context:
+    def __init__(self, args, db_path):
+        self.users = args.users
+        self.n_fixture = min(args.users, args.fixture_users)
+        self.n_players = args.n_players
+        self.rng_lock = threading.Lock()
+        self.rng = random.Random(args.seed)
+        self.listings = queue.Queue()
+        self.trades = queue.Queue()
+        self.daily_users = queue.Queue()
+
+        conn = sqlite3.connect(db_path)
+        # Buy from seeded listings of non-fixture sellers so fixture buyers never self-buy.
+        for (lid,) in conn.execute("SELECT id FROM market_listings WHERE status='active' AND seller_id>? ORDER BY id",
+                                   (self.n_fixture,)):
+            self.listings.put(lid)
+        conn.close()
+        for uid in range(self.n_fixture + 1, self.users + 1):
+            self.daily_users.put(uid)
+
+    def rand_user(self):
+        with self.rng_lock:
+            return self.rng.randint(1, self.users)
+
+    def rand_player(self):
+        with self.rng_lock:
+            return self.rng.randint(1, self.n_players)
+
+    def fixture_user(self):
+        with self.rng_lock:
+            return self.rng.randint(1, self.n_fixture)
+
+    def fixture_pair(self):
+        with self.rng_lock:
+            a = self.rng.randint(1, self.n_fixture)
+            b = self.rng.randint(1, self.n_fixture - 1)
+        return a, (b if b < a else b + 1)
+
+    def owned_player(self, uid):
+        return (uid % self.n_players) + 1
+
+
+def flow_bootstrap(t, ctx):
+    return t.get(f"/api/bootstrap?user_id={ctx.rand_user()}")
+
+def flow_sync(t, ctx):
+    # a client that is one change behind (gen_data leaves every user at rev 1)
+    return t.get(f"/api/sync?user_id={ctx.rand_user()}&since=1")
+
+def flow_players(t, ctx):
+    return t.get("/api/players")
+
+def flow_clubs(t, ctx):
+    return t.get("/api/clubs")
+
+def flow_tx(t, ctx):
+    return t.get(f"/api/tx?user_id={ctx.rand_user()}&limit=50")
+
+def flow_level(t, ctx):
+    return t.get(f"/api/level?user_id={ctx.rand_user()}")
+
+def flow_vip(t, ctx):
+    return t.get(f"/api/vip?user_id={ctx.rand_user()}")
+
+def flow_market_list(t, ctx):
+    return t.get("/api/market/list")
+
+def flow_market_stats(t, ctx):
+    return t.get(f"/api/market/stats?player_id={ctx.rand_player()}")
+
+def flow_p2p_list(t, ctx):
+    return t.get(f"/api/p2p_player/list?user_id={ctx.fixture_user()}")
+
+def flow_set_club(t, ctx):
+    return t.post("/api/set_club", {"user_id": ctx.fixture_user(), "club_id": 1, "club_name": "Bench FC"})
+
+def flow_daily_claim(t, ctx):
+    try:
+        uid = ctx.daily_users.get_nowait()
+    except queue.Empty:
+        return None
+    return t.post("/api/daily/claim", {"user_id": uid})
+
+def flow_open_pack(t, ctx):
+    return t.post("/api/open_pack", {"user_id": ctx.fixture_user()})
+
+def flow_match_play(t, ctx):
+    return t.post("/api/match/play", {"user_id": ctx.fixture_user()})
+
+def flow_market_sell(t, ctx):
+    uid = ctx.fixture_user()
+    return t.post("/api/market/sell", {"user_id": uid, "player_id": ctx.owned_player(uid), "price": 100})
+
+def flow_market_buy(t, ctx):
+    try:
+        lid = ctx.listings.get_nowait()
+    except queue.Empty:
+        return None
+    return t.post("/api/market/buy", {"user_id": ctx.fixture_user(), "listing_id": lid})
+
+def flow_p2p_create(t, ctx):
+    seller, buyer = ctx.fixture_pair()
+    status, body = t.post("/api/p2p_player/create", {
+        "seller_id": seller, "buyer_id": buyer, "player_id": ctx.owned_player(seller), "price": 100})
+    if body.get("ok"):
+        ctx.trades.put((body["trade_id"], seller, buyer))
+    return status, body
+
+def flow_p2p_accept(t, ctx):
+    try:
+        trade_id, _, buyer = ctx.trades.get_nowait()
+    except queue.Empty:
+        return None
+    return t.post("/api/p2p_player/accept", {"trade_id": trade_id, "user_id": buyer})
+
+def flow_p2p_cancel(t, ctx):
+    try:
+        trade_id, seller, _ = ctx.trades.get_nowait()
+    except queue.Empty:
+        return None
+    return t.post("/api/p2p_player/cancel", {"trade_id": trade_id, "user_id": seller})
+
+# (name, fn, share of --requests). Order matters: creators run before consumers.
+# /api/create_invoice is left out on purpose, it is a round trip to the Bot API.
+FLOWS = [
+    ("bootstrap", flow_bootstrap, 1.0),
+    ("sync", flow_sync, 1.0),
+    ("players", flow_players, 0.5),
+    ("clubs", flow_clubs, 0.5),
+    ("tx", flow_tx, 0.5),
+    ("level", flow_level, 0.5),
+    ("vip", flow_vip, 0.5),
+    ("market_list", flow_market_list, 1.0),
+    ("market_stats", flow_market_stats, 1.0),
+    ("p2p_list", flow_p2p_list, 1.0),
+    ("set_club", flow_set_club, 0.5),
+    ("daily_claim", flow_daily_claim, 0.5),
+    ("open_pack", flow_open_pack, 1.0),
+    ("match_play", flow_match_play, 1.0),
+    ("market_sell", flow_market_sell, 1.0),
+    ("market_buy", flow_market_buy, 1.0),
+    ("p2p_create", flow_p2p_create, 1.0),
+    ("p2p_accept", flow_p2p_accept, 0.5),
+    ("p2p_cancel", flow_p2p_cancel, 0.5),
+]
+
+# =========================
+# Runner
+# =========================
+def percentile(sorted_vals, pct):
+    if not sorted_vals:
+        return 0.0
+    k = max(0, min(len(sorted_vals) - 1, int(round(pct / 100.0 * len(sorted_vals) + 0.5)) - 1))
+    return sorted_vals[k]
+
+
+def summarize(latencies, errors, elapsed):
+    lat = sorted(latencies)
+    n = len(lat)
+    return {
+        "requests": n,
+        "errors": errors,
+        "rps": round(n / elapsed, 1) if elapsed > 0 else 0.0,
+        "mean_ms": round(sum(lat) / n, 3) if n else 0.0,
+        "p50_ms": round(percentile(lat, 50), 3),
+        "p95_ms": round(percentile(lat, 95), 3),
+        "p99_ms": round(percentile(lat, 99), 3),
+        "max_ms": round(lat[-1], 3) if n else 0.0,
+    }
+
+
+def run_flow(fn, n, concurrency, make_transport, ctx):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    remaining = [n]
+
+    def worker():
+        t = make_transport()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            t0 = time.perf_counter()
+            res = fn(t, ctx)
+            dt = (time.perf_counter() - t0) * 1000.0
+            if res is None:  # nothing left to consume
+                continue
+            status, body = res
+            with lock:
+                latencies.append(dt)
+                if status >= 400 or not body.get("ok"):
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, concurrency))]
+    t0 = time.perf_counter()
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    return summarize(latencies, errors[0], time.perf_counter() - t0)
+
+
+def bench_serialization(server, n_rows=50, n_inventory=500, rounds=2000):
+    """Before/after cost of encoding list responses (market list, bootstrap inventory)."""
+    players = list(server.PLAYERS_BY_ID.values())
+    rows = [{"id": i, "seller_id": 1000 + i, "player_id": int(players[i % len(players)]["id"]), "price": 100 + i,
+             "status": "active", "created_at": 1700000000 + i} for i in range(n_rows)]
+    inv = [(int(players[i % len(players)]["id"]), 1 + i % 3) for i in range(n_inventory)]
+
+    def merged_rows():
+        return {"ok": True, "items": [{**r, "player": server.PLAYERS_BY_ID[r["player_id"]]} for r in rows]}
+
+    def merged_inventory():
+        return {"ok": True, "inventory": [{"player": server.PLAYERS_BY_ID[pid], "qty": q} for pid, q in inv]}
+
+    def flask_default(obj):
+        # what jsonify did before: stdlib, sorted keys, ascii escaping
+        return json.dumps(obj, ensure_ascii=True, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+    cases = [
+        (f"market_list[{n_rows}] jsonify_stdlib", lambda: flask_default(merged_rows())),
+        (f"market_list[{n_rows}] provider_merge", lambda: server.encode_json(merged_rows())),
+        (f"market_list[{n_rows}] server_path", lambda: server.join_json_object(
+            {"ok": True}, items=server.encode_rows_with_player(rows))),
+        (f"inventory[{n_inventory}] jsonify_stdlib", lambda: flask_default(merged_inventory())),
+        (f"inventory[{n_inventory}] provider_merge", lambda: server.encode_json(merged_inventory())),
+        (f"inventory[{n_inventory}] server_path", lambda: server.join_json_object(
+            {"ok": True}, inventory=server.encode_inventory(inv))),
+    ]
+    results = {"orjson": server.orjson is not None}
+    for name, fn in cases:
+        size = len(fn())
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            fn()
+        dt = time.perf_counter() - t0
+        results[name] = {"us_per_op": round(dt / rounds * 1e6, 2), "ops": round(rounds / dt, 1), "bytes": size}
+        print(f"{name:<36} {results[name]['us_per_op']:>10} us/op  {results[name]['bytes']:>8} bytes", flush=True)
+    return results
+
+
+def _shard_writer(server, users, deadline, seed, out):
+    rng = random.Random(seed)
+    ok = errors = 0
+    while time.time() < deadline:
+        try:
+            server.add_coins(rng.randint(1, users), 1, kind="bench", note="shard write")
+            ok += 1
+        except sqlite3.OperationalError:
+            errors += 1
+    out.put((ok, errors))
+
+
+def bench_shard_writes(server, workdir, shard_counts=(1, 4, 8), writers=8, users=10000, seconds=5.0):
+    """Coins+tx_log writes/s from `writers` processes against 1, 4 and 8 shard files."""
+    import multiprocessing
+
+    ctx = multiprocessing.get_context("fork")
+    results = {}
+    for n in shard_counts:
+        d = os.path.join(workdir, f"shards{n}")
+        os.makedirs(d, exist_ok=True)
+        server.DB_PATH = os.path.join(d, "game.db")
+        server.DB_SHARDS = n
+        server.migrate(log=lambda _: None)
+        for path in server.shard_paths():
+            conn = sqlite3.connect(path)
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO users(user_id, username) VALUES(?,?)",
+                                 ((uid, f"user{uid}") for uid in range(1, users + 1)
+                                  if server.shard_index(uid) == server.shard_paths().index(path)))
+            conn.close()
+
+        out = ctx.Queue()
+        deadline = time.time() + seconds
+        procs = [ctx.Process(target=_shard_writer, args=(server, users, deadline, i, out)) for i in range(writers)]
+        for p in procs:
+            p.start()
+        totals = [out.get() for _ in procs]
+        for p in procs:
+            p.join()
+        ok = sum(t[0] for t in totals)
+        results[str(n)] = {"writes": ok, "errors": sum(t[1] for t in totals),
+                           "writes_per_s": round(ok / seconds, 1), "writers": writers}
+        print(f"shards={n:<3} {results[str(n)]['writes_per_s']:>10} writes/s  errors {results[str(n)]['errors']}",
+              flush=True)
+    return results
+
+
+def bench_boot(server, workdir, env, runs=5):
+    """Worker start-up: import time of server.py in fresh processes, before and after `migrate.py`."""
+    paths = sorted(set(server.shard_paths()) | {server.DB_PATH})
+    cmd = [sys.executable, "-c", "import json, server; print(json.dumps([server.BOOT_SECONDS, len(server.SCHEMA_PENDING)]))"]
+
+    def boot():
+        out = subprocess.run(cmd, cwd=workdir, env=env, capture_output=True, text=True, check=True)
+        return json.loads(out.stdout.strip().splitlines()[-1])
+
+    pending = boot()[1]
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, "migrate.py"], cwd=workdir, env=env, capture_output=True, check=True)
+    migrate_s = time.perf_counter() - t0
+    before = _db_fingerprint(paths)
+    samples = sorted(boot()[0] for _ in range(runs))
+    result = {"pending_files_before": pending, "migrate_seconds": round(migrate_s, 3),
+              "boot_ms_p50": round(samples[len(samples) // 2] * 1000, 1),
+              "boot_ms_max": round(samples[-1] * 1000, 1),
+              "boot_writes_db": _db_fingerprint(paths) != before}
+    print(f"migrate {result['migrate_seconds']}s, worker import p50 {result['boot_ms_p50']}ms "
+          f"max {result['boot_ms_max']}ms, import wrote to db: {result['boot_writes_db']}", flush=True)
+    return result
+
+
+def _db_fingerprint(paths):
+    import hashlib
+
+    fp = {}
+    for path in paths:
+        h = hashlib.sha1()
+        for p in (path, path + "-wal"):
+            if os.path.exists(p):
+                with open(p, "rb") as f:
+                    h.update(f.read())
+        fp[path] = h.hexdigest()
+    return fp
+
+
+def check_readonly(server, users):
+    """Call every GET /api route for a known and an unknown user and assert no DB file changed."""
+    paths = sorted(set(server.shard_paths()) | {server.DB_PATH})
+    server.EVENTS_STREAM = True  # check the stream's replay too, not just the 204
+    client = server.app.test_client()
+    client.get("/api/market/list")  # open pooled readers before taking the fingerprint
+    before = _db_fingerprint(paths)
+    failures = []
+    for rule in server.app.url_map.iter_rules():
+        if "GET" not in rule.methods or not rule.rule.startswith("/api/") or rule.arguments:
+            continue
+        for uid in (1, users + 12345):
+            # unbuffered so /api/events (an endless stream) just reports its status
+            r = client.get(f"{rule.rule}?user_id={uid}", buffered=False)
+            if r.status_code >= 500:
+                failures.append(f"{rule.rule} user {uid}: HTTP {r.status_code} {r.get_data(as_text=True)[:200]}")
+            r.close()
+    after = _db_fingerprint(paths)
+    failures += [f"{p} changed" for p in paths if before[p] != after[p]]
+    for f in failures:
+        print("FAIL", f)
+    print("readonly check:", "ok" if not failures else f"{len(failures)} failure(s)")
+    return {"ok": not failures, "failures": failures}
+
+
+def wait_http(base_url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(base_url + "/health", timeout=2):
+                return True
+        except Exception:
+            time.sleep(0.2)
+    return False
+
+
+def start_server(args, workdir, env, kind="gunicorn"):
+    if kind == "uvicorn":
+        cmd = [sys.executable, "-m", "uvicorn", "--workers", str(args.workers), "--host", "127.0.0.1", "--port", str(args.port),
+               "--app-dir", workdir, "--log-level", "warning", "--no-access-log", "asgi:app"]
+    else:
+        cmd = [sys.executable, "-m", "gunicorn", "-w", str(args.workers), "-b", f"127.0.0.1:{args.port}",
+               "--chdir", workdir, "--log-level", "warning", "server:app"]
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env)
+    base_url = f"http://127.0.0.1:{args.port}"
+    if not wait_http(base_url):
+        proc.terminate()
+        raise SystemExit(f"server did not come up: {' '.join(cmd)}")
+    return proc, base_url
+
+
+class IdleSessions:
+    """Hold N client connections open mid-request, like Mini App users on slow mobile links."""
+
+    def __init__(self, port, n):
+        import socket
+
+        self.socks = []
+        for _ in range(n):
+            s = socket.create_connection(("127.0.0.1", port), timeout=5)
+            s.sendall(b"GET /api/players HTTP/1.1\r\nHost: 127.0.0.1\r\n")  # headers never finished
+            self.socks.append(s)
+
+    def close(self):
+        for s in self.socks:
+            s.close()
+
+
+def start_backups(workdir, env):
+    """backup.py looping next to the flows (--backup), to see what online backups do to p99."""
+    return subprocess.Popen([sys.executable, "backup.py", "--out", os.path.join(workdir, "backups"),
+                             "--every", "0.5", "--keep", "1", "--probe", "0"],
+                            cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+
+
+def stop_backups(proc):
+    proc.terminate()
+    out, _ = proc.communicate(timeout=30)
+    runs = [json.loads(line) for line in out.splitlines() if line.startswith('{"dir"')]
+    return {"runs": len(runs), "bytes": runs[-1]["bytes"] if runs else 0,
+            "seconds_max": max((r["seconds"] for r in runs), default=None)}
+
+
+def snapshot_db(paths, restore=False):
+    """Copy the seeded files aside (or back) so each server in --mode compare starts from the same data."""
+    for path in paths:
+        if restore:
+            for suffix in ("-wal", "-shm"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+            shutil.copyfile(path + ".seed", path)
+        else:
+            shutil.copyfile(path, path + ".seed")
+
+
+def run_flows(args, make_transport, ctx):
+    wanted = {f.strip() for f in args.flows.split(",") if f.strip()}
+    flows = {}
+    for name, fn, share in FLOWS:
+        if wanted and name not in wanted:
+            continue
+        n = max(1, int(args.requests * share))
+        flows[name] = run_flow(fn, n, args.concurrency, make_transport, ctx)
+        r = flows[name]
+        print(f"{name:<14} {r['rps']:>9} rps  p50 {r['p50_ms']:>8}ms  p95 {r['p95_ms']:>8}ms  "
+              f"p99 {r['p99_ms']:>8}ms  errors {r['errors']}", flush=True)
+    return flows
+
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                             capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compare(baseline, report):
+    print(f"{'flow':<14}{'rps':>10}{'Δrps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'Δp99':>9}")
+    for name, cur in report["flows"].items():
+        old = baseline.get("flows", {}).get(name)
+
+        def pct(a, b):
+            return f"{(b - a) / a * 100:+.0f}%" if old and a else "n/a"
+
+        print(f"{name:<14}{cur['rps']:>10}{pct(old['rps'] if old else 0, cur['rps']):>9}"
+              f"{cur['p50_ms']:>9}{cur['p95_ms']:>9}{cur['p99_ms']:>9}"
+              f"{pct(old['p99_ms'] if old else 0, cur['p99_ms']):>9}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--mode", choices=["client", "gunicorn", "uvicorn", "compare"], default="client",
+                    help="client: in-process Flask test client; gunicorn: real HTTP against local workers; "
+                         "uvicorn: same against asgi:app; compare: gunicorn then uvicorn on identical data")
+    ap.add_argument("--users", type=int, default=2000)
+    ap.add_argument("--inventory", type=int, default=20000, help="inventory rows")
+    ap.add_argument("--listings", type=int, default=10000, help="market_listings rows")
+    ap.add_argument("--active-share", type=float, default=0.5, help="share of listings still active")
+    ap.add_argument("--trades", type=int, default=2000, help="p2p_player_trades rows")
+    ap.add_argument("--tx", type=int, default=50000, help="tx_log rows")
+    ap.add_argument("--fixture-users", type=int, default=200, help="rich users used by write flows")
+    ap.add_argument("--requests", type=int, default=300, help="requests per flow (scaled by flow share)")
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--workers", type=int, default=4, help="gunicorn/uvicorn workers")
+    ap.add_argument("--port", type=int, default=5077)
+    ap.add_argument("--idle-sessions", type=int, default=0,
+                    help="HTTP modes: connections kept open with an unfinished request while the flows run")
+    ap.add_argument("--flows", default="", help="comma separated subset of flows")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", default="", help="write JSON report here")
+    ap.add_argument("--baseline", default="", help="previous JSON report to diff against")
+    ap.add_argument("--serialization", action="store_true",
+                    help="only run the JSON encoding micro-benchmark")
+    ap.add_argument("--check-readonly", action="store_true",
+                    help="assert that no GET /api endpoint writes to the database (exit 1 if one does)")
+    ap.add_argument("--boot", action="store_true",
+                    help="measure worker import time and migrate.py on an empty database, then exit")
+    ap.add_argument("--backup", action="store_true", help="run backup.py in a loop while the flows run")
+    ap.add_argument("--shard-writes", action="store_true",
+                    help="only measure write throughput at 1, 4 and 8 DB_SHARDS")
+    ap.add_argument("--writers", type=int, default=8, help="writer processes for --shard-writes")
+    ap.add_argument("--seconds", type=float, default=5.0, help="duration per shard count for --shard-writes")
+    ap.add_argument("--keep", action="store_true", help="keep the temp workdir")
+    args = ap.parse_args(argv)
+
+    workdir = make_workdir()
+    db_path = os.path.join(workdir, "game.db")
+    # fixture users fire far faster than anyone taps; set ADMIT_RATE to measure the limiter itself
+    os.environ.setdefault("ADMIT_RATE", "0")
+    env = dict(os.environ, DB_PATH=db_path)
+    os.environ["DB_PATH"] = db_path
+    proc = None
+    flows, extra, seed_s, shards = {}, {}, 0.0, 1
+    try:
+        os.chdir(workdir)
+        sys.path.insert(0, workdir)
+        import server  # noqa: E402
+        import gen_data  # noqa: E402
+
+        args.n_players = max(1, len(server.PLAYERS))
+        shards = server.DB_SHARDS
+        if args.boot:
+            extra["boot"] = bench_boot(server, workdir, env)
+        elif args.serialization:
+            extra["serialization"] = bench_serialization(server)
+        elif args.check_readonly:
+            gen_data.populate(db_path, server.PLAYERS, server.CLUBS, users=200, inventory=2000, listings=200,
+                              trades=50, tx=2000, seed=args.seed, log=lambda _: None)
+            extra["readonly"] = check_readonly(server, 200)
+        elif args.shard_writes:
+            extra["shard_writes"] = bench_shard_writes(server, workdir, writers=args.writers,
+                                                       users=args.users, seconds=args.seconds)
+        else:
+            t0 = time.perf_counter()
+            gen_data.populate(db_path, server.PLAYERS, server.CLUBS, users=args.users, inventory=args.inventory,
+                              listings=args.listings, trades=args.trades, tx=args.tx,
+                              active_share=args.active_share, seed=args.seed, log=lambda _: None)
+            add_bench_fixture(server, min(args.users, args.fixture_users), args.n_players)
+            seed_s = time.perf_counter() - t0
+            backups = start_backups(workdir, env) if args.backup else None
+            if args.mode == "client":
+                flows = run_flows(args, lambda: TestClientTransport(server.app), Context(args, db_path))
+            elif args.mode == "compare":
+                paths = sorted(set(server.shard_paths()) | {db_path})
+                snapshot_db(paths)
+                servers = {}
+                for kind in ("gunicorn", "uvicorn"):
+                    snapshot_db(paths, restore=True)
+                    print(f"--- {kind}", flush=True)
+                    proc, base_url = start_server(args, workdir, env, kind)
+                    idle = IdleSessions(args.port, args.idle_sessions)
+                    servers[kind] = run_flows(args, lambda: HttpTransport(base_url), Context(args, db_path))
+                    idle.close()
+                    proc.terminate()
+                    proc.wait(timeout=10)
+                    proc = None
+                print("--- uvicorn vs gunicorn")
+                compare({"flows": servers["gunicorn"]}, {"flows": servers["uvicorn"]})
+                flows, extra["servers"] = servers["uvicorn"], servers
+            else:
+                proc, base_url = start_server(args, workdir, env, args.mode)
+                idle = IdleSessions(args.port, args.idle_sessions)
+                flows = run_flows(args, lambda: HttpTransport(base_url), Context(args, db_path))
+                idle.close()
+            if backups:
+                extra["backup"] = stop_backups(backups)
+                print(f"backups during the run: {extra['backup']}", flush=True)
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait(timeout=10)
+        os.chdir(ROOT)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "mode": args.mode,
+            "concurrency": args.concurrency,
+            "workers": args.workers if args.mode != "client" else None,
+            "requests": args.requests,
+            "sizes": {"users": args.users, "inventory": args.inventory, "listings": args.listings,
+                      "trades": args.trades, "tx_log": args.tx},
+            "seed": args.seed,
+            "seed_seconds": round(seed_s, 2),
+            "db_shards": shards,
+            "python": platform.python_version(),
+            "timestamp": int(time.time()),
+        },
+        "flows": flows,
+        **extra,
+    }
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            compare(json.load(f), report)
+    if "readonly" in extra and not extra["readonly"]["ok"]:
+        raise SystemExit(1)
+    return report
+
+
+if __name__ == "__main__":
+    main()
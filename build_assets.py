@@ -0,0 +1,149 @@
+"""Build the Mini App static assets into dist/ (served by server.py, see ASSET_DIR).
+
+    python build_assets.py            # before starting the app / in the deploy build step
+
+- JS, CSS and images get a content hash in the file name (script.3f9c1a2b7e.js) so
+  they can be cached forever; index.html keeps its name and is revalidated.
+- /web/<file> references inside html/css/js are rewritten to the hashed URLs.
+- Text assets get .gz (and .br with the `brotli` package) siblings next to them.
+  The Mini App (index.html) inlines its CSS/JS, so for it that is the win;
+  web/script.js and web/style.css belong to the old UI, no page links them.
+- Player/club images from static/players and static/clubs get WebP thumbnails
+  (THUMB_SIZES, needs Pillow); without Pillow only the originals are copied.
+- dist/manifest.json maps logical names to the built files.
+"""
+import os
+import re
+import gzip
+import json
+import shutil
+import hashlib
+import argparse
+
+try:
+    import brotli
+except ImportError:  # optional, gzip only
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:  # optional, no thumbnails
+    Image = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+WEB_DIR = "web"
+IMAGE_DIRS = {"players": os.path.join("static", "players"), "clubs": os.path.join("static", "clubs")}
+IMAGE_EXT = (".png", ".jpg", ".jpeg", ".webp", ".gif")
+TEXT_EXT = (".css", ".js", ".svg", ".json", ".html")  # build order: html last, it references the rest
+THUMB_SIZES = (96, 192)  # card image at 1x / 2x
+MIN_COMPRESS = 256  # bytes; smaller files don't win anything
+
+
+def digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:10]
+
+
+def hashed_name(name: str, h: str, suffix: str = "") -> str:
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{h}{suffix or ext}"
+
+
+def write(out, rel, data: bytes):
+    path = os.path.join(out, rel)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def compress(out, rel, data: bytes) -> list:
+    encodings = []
+    if len(data) < MIN_COMPRESS:
+        return encodings
+    if brotli is not None:
+        br = brotli.compress(data, quality=11)
+        if len(br) < len(data):
+            write(out, rel + ".br", br)
+            encodings.append("br")
+    gz = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gz) < len(data):
+        write(out, rel + ".gz", gz)
+        encodings.append("gzip")
+    return encodings
+
+
+def build_images(out, manifest, log):
+    for kind, src_dir in IMAGE_DIRS.items():
+        src_dir = os.path.join(ROOT, src_dir)
+        if not os.path.isdir(src_dir):
+            continue
+        for name in sorted(os.listdir(src_dir)):
+            if not name.lower().endswith(IMAGE_EXT):
+                continue
+            with open(os.path.join(src_dir, name), "rb") as f:
+                data = f.read()
+            h = digest(data)
+            rel = f"images/{kind}/{hashed_name(name, h)}"
+            write(out, rel, data)
+            manifest["files"][f"images/{kind}/{name}"] = rel
+            entry = {"src": rel, "webp": {}}
+            if Image is not None:
+                with Image.open(os.path.join(src_dir, name)) as im:
+                    im = im.convert("RGBA" if im.mode in ("RGBA", "LA", "P") else "RGB")
+                    for size in THUMB_SIZES:
+                        thumb = im.copy()
+                        thumb.thumbnail((size, size), Image.LANCZOS)
+                        thumb_rel = f"images/{kind}/{hashed_name(name, h, f'.{size}.webp')}"
+                        path = os.path.join(out, thumb_rel)
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        thumb.save(path, "WEBP", quality=80, method=6)
+                        entry["webp"][str(size)] = thumb_rel
+            manifest["images"][f"{kind}/{name}"] = entry
+        log(f"images/{kind}: {sum(1 for k in manifest['images'] if k.startswith(kind + '/'))}")
+
+
+def build_text(out, manifest, log):
+    names = [n for n in os.listdir(os.path.join(ROOT, WEB_DIR)) if n.endswith(TEXT_EXT)]
+    names.sort(key=lambda n: (n.endswith(".html"), n))
+    for name in names:
+        with open(os.path.join(ROOT, WEB_DIR, name), "rb") as f:
+            data = f.read()
+        # longest first so /web/a.js doesn't eat into /web/a.js.map
+        refs = sorted(manifest["files"], key=len, reverse=True)
+        if refs:
+            pattern = re.compile(r"/web/(%s)(?![\w.-])" % "|".join(re.escape(r) for r in refs))
+            data = pattern.sub(lambda m: "/web/assets/" + manifest["files"][m.group(1)], data.decode("utf-8")).encode("utf-8")
+        rel = name if name.endswith(".html") else hashed_name(name, digest(data))
+        write(out, rel, data)
+        manifest["files"][name] = rel
+        manifest["compressed"][rel] = compress(out, rel, data)
+        sizes = " ".join(f"{e}={os.path.getsize(os.path.join(out, rel + ('.br' if e == 'br' else '.gz')))}"
+                         for e in manifest["compressed"][rel])
+        log(f"{name:<14} -> {rel:<28} {len(data):>7} {sizes}")
+
+
+def build(out=None, log=print):
+    out = os.path.abspath(out or os.path.join(ROOT, "dist"))
+    tmp = out + ".new"
+    shutil.rmtree(tmp, ignore_errors=True)
+    manifest = {"files": {}, "images": {}, "compressed": {}}
+    build_images(tmp, manifest, log)
+    build_text(tmp, manifest, log)
+    write(tmp, "manifest.json", json.dumps(manifest, indent=1, sort_keys=True).encode("utf-8"))
+    shutil.rmtree(out, ignore_errors=True)
+    os.replace(tmp, out)
+    if Image is None:
+        log("Pillow not installed: no WebP thumbnails")
+    if brotli is None:
+        log("brotli not installed: gzip only")
+    return manifest
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--out", default="", help="output dir (default: dist/ next to this file)")
+    args = ap.parse_args(argv)
+    build(args.out or None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+"""Synthetic data generator for scale-testing game.db.
+
+Creates the schema through server.migrate() and fills every table with
+realistic, reproducible data (same --seed -> same database). Honors
+DB_SHARDS: per-user rows go to the shard files next to --db.
+
+    python gen_data.py --db /tmp/big.db --users 300000 --inventory 3000000 --tx 5000000
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+
+BATCH = 50_000
+
+# Relative pull of each rarity when a card drops / gets listed.
+RARITY_WEIGHT = {"common": 50, "rare": 25, "epic": 10, "legendary": 3}
+RARITY_PRICE = {"common": 150, "rare": 400, "epic": 1200, "legendary": 4000}
+
+# tx_log kinds as written by server.py, weighted by how often they happen.
+TX_KINDS = [
+    ("xp", 30), ("match", 25), ("daily", 8), ("pack_open", 8), ("packs_add", 2),
+    ("market_buy", 4), ("market_sell", 4), ("level_up", 3), ("coins_add", 1),
+    ("stars_buy", 1), ("vip", 1), ("p2p_player_lock", 2), ("p2p_player_pay", 1),
+    ("p2p_player_receive_coins", 1), ("p2p_player_refund", 1),
+]
+
+
+def player_rating(p):
+    if "rating" in p:
+        return int(p["rating"])
+    stats = [int(p.get(k, 50)) for k in ("attack", "defense", "speed")]
+    return int(sum(stats) / len(stats))
+
+
+def player_table(players):
+    """(ids, cum_weights, price_by_id) - ids fall back to list position like bench.py does."""
+    ids, cum, prices = [], [], {}
+    acc = 0
+    for i, p in enumerate(players):
+        pid = int(p.get("id", i + 1))
+        rating = player_rating(p)
+        acc += RARITY_WEIGHT.get(p.get("rarity"), 20) * max(1, 100 - rating)
+        ids.append(pid)
+        cum.append(acc)
+        prices[pid] = RARITY_PRICE.get(p.get("rarity"), 300) + rating * 5
+    return ids, cum, prices
+
+
+def batched(gen, size=BATCH):
+    buf = []
+    for row in gen:
+        buf.append(row)
+        if len(buf) >= size:
+            yield buf
+            buf = []
+    if buf:
+        yield buf
+
+
+def populate(path, players, clubs, users=1000, inventory=10000, listings=2000, trades=500,
+             tx=20000, purchases=100, vip_share=0.05, active_share=0.2, days=30, seed=1, log=print):
+    import server
+
+    # schema and shard files follow `path`, not the DB_PATH server was imported with
+    server.DB_PATH = os.path.abspath(path)
+    server.migrate(log=lambda _: None)
+    rng = random.Random(seed)
+    now = int(time.time())
+    start = now - days * 86400
+    pids, pcum, price = player_table(players) if players else ([1], [1], {1: 300})
+    club_ids = [int(c.get("id", i + 1)) for i, c in enumerate(clubs)] or [0]
+    kinds, kind_w = zip(*TX_KINDS)
+
+    def whale():
+        # Skewed towards low ids: a few heavy collectors, a long tail of casuals.
+        return int(users * rng.random() ** 2.5) + 1
+
+    def pick_players(k):
+        return rng.choices(pids, cum_weights=pcum, k=k)
+
+    def ask(pid):
+        return max(10, int(price[pid] * rng.uniform(0.6, 1.6)))
+
+    def ts():
+        return rng.randint(start, now)
+
+    def gen_users():
+        for uid in range(1, users + 1):
+            club = rng.choice(club_ids) if rng.random() < 0.7 else 0
+            yield (uid, f"user{uid}", club, f"FC {uid}" if club else "",
+                   int(rng.lognormvariate(6.5, 1.2)), rng.choice((0, rng.randint(now - 3 * 86400, now))),
+                   0 if rng.random() < 0.8 else rng.randint(1, 5), ts())
+
+    def gen_levels():
+        for uid in range(1, users + 1):
+            lvl = min(99, 1 + int(rng.expovariate(1 / 6)))
+            yield (uid, rng.randint(0, server.xp_needed(lvl) - 1), lvl)
+
+    def gen_vip():
+        for uid in rng.sample(range(1, users + 1), int(users * vip_share)):
+            yield (uid, now + rng.randint(-30, 30) * 86400)
+
+    def gen_inventory():
+        left = inventory
+        while left > 0:
+            k = min(left, 1000)
+            for pid in pick_players(k):
+                yield (whale(), pid, 1 if rng.random() < 0.85 else rng.randint(2, 4))
+            left -= k
+
+    def gen_listings():
+        left = listings
+        while left > 0:
+            k = min(left, 1000)
+            for pid in pick_players(k):
+                created = ts()
+                roll = rng.random()
+                if roll < active_share:
+                    yield (whale(), pid, ask(pid), "active", created, None)
+                elif roll < 0.95:
+                    yield (whale(), pid, ask(pid), "sold", created,
+                           min(now, created + int(rng.expovariate(1 / 3600))))
+                else:
+                    yield (whale(), pid, ask(pid), "canceled", created, None)
+            left -= k
+
+    def gen_trades():
+        for pid in pick_players(trades):
+            seller = whale()
+            buyer = rng.randint(1, users)
+            if buyer == seller:
+                buyer = buyer % users + 1
+            p = ask(pid)
+            created = ts()
+            status = rng.choices(("pending", "accepted", "canceled"), weights=(2, 6, 2))[0]
+            yield (seller, buyer, pid, p, max(1, int(p * server.P2P_PLAYER_FEE_PCT / 100)), status,
+                   created, min(now, created + rng.randint(60, 86400)) if status == "accepted" else None)
+
+    def gen_tx():
+        # ids grow with time, like the real append-only log
+        step = (now - start) / max(1, tx)
+        left, i = tx, 0
+        while left > 0:
+            k = min(left, 1000)
+            for kind in rng.choices(kinds, weights=kind_w, k=k):
+                if kind in ("match", "daily", "market_sell", "p2p_player_receive_coins", "coins_add", "stars_buy"):
+                    delta = rng.randint(50, 1500)
+                elif kind in ("market_buy", "p2p_player_pay"):
+                    delta = -rng.randint(50, 3000)
+                elif kind == "level_up":
+                    delta = 50
+                else:
+                    delta = 0
+                yield (whale(), kind, delta, kind, int(start + i * step))
+                i += 1
+            left -= k
+
+    def gen_purchases():
+        for n in range(purchases):
+            uid = rng.randint(1, users)
+            yield (f"synthetic_{seed}_{n}", uid, f"{rng.choice(list(server.CATALOG))}:{uid}:{ts()}", ts())
+
+    # (table, sql, rows, per-user?) - per-user rows are routed to their shard by row[0] (user_id)
+    plan = [
+        ("users", "INSERT INTO users(user_id, username, club_id, club_name, coins, last_daily, pack_credits, created_at) "
+                  "VALUES(?,?,?,?,?,?,?,?)", gen_users, True),
+        ("user_level", "INSERT INTO user_level(user_id, xp, level) VALUES(?,?,?)", gen_levels, True),
+        ("vip", "INSERT INTO vip(user_id, vip_until) VALUES(?,?)", gen_vip, True),
+        ("inventory", "INSERT INTO inventory(user_id, player_id, qty) VALUES(?,?,?) "
+                      "ON CONFLICT(user_id, player_id) DO UPDATE SET qty = qty + excluded.qty", gen_inventory, True),
+        ("market_listings", "INSERT INTO market_listings(seller_id, player_id, price, status, created_at, sold_at) "
+                            "VALUES(?,?,?,?,?,?)", gen_listings, False),
+        ("p2p_player_trades", "INSERT INTO p2p_player_trades(seller_id, buyer_id, player_id, price, fee, status, "
+                              "created_at, accepted_at) VALUES(?,?,?,?,?,?,?,?)", gen_trades, False),
+        ("tx_log", "INSERT INTO tx_log(user_id, kind, delta, note, created_at) VALUES(?,?,?,?,?)", gen_tx, True),
+        ("purchases", "INSERT INTO purchases(tg_charge_id, user_id, payload, created_at) VALUES(?,?,?,?)",
+         gen_purchases, False),
+    ]
+
+    shards = server.shard_paths()
+    conns = {}
+    for p in set(shards) | {path}:
+        conn = sqlite3.connect(p, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("PRAGMA locking_mode=EXCLUSIVE")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-262144")  # 256 MiB
+        conn.execute("BEGIN")
+        conns[p] = conn
+    shard_conns = [conns[p] for p in shards]
+    # the user_rev / market_stats triggers would double the cost of every insert;
+    # revs and market stats are set once at the end
+    triggers = {}
+    for conn in conns.values():
+        rows = conn.execute("SELECT name, sql FROM sqlite_master WHERE type='trigger'").fetchall()
+        triggers[conn] = [sql for _, sql in rows]
+        for name, _ in rows:
+            conn.execute(f"DROP TRIGGER {name}")
+
+    stats = {}
+    t_all = time.perf_counter()
+    try:
+        for table, sql, gen, per_user in plan:
+            t0 = time.perf_counter()
+            n = 0
+            for chunk in batched(gen()):
+                if per_user and len(shard_conns) > 1:
+                    routed = [[] for _ in shard_conns]
+                    for row in chunk:
+                        routed[server.shard_index(row[0])].append(row)
+                    for conn, rows in zip(shard_conns, routed):
+                        conn.executemany(sql, rows)
+                else:
+                    (shard_conns[0] if per_user else conns[path]).executemany(sql, chunk)
+                n += len(chunk)
+            dt = time.perf_counter() - t0
+            stats[table] = {"rows": n, "seconds": round(dt, 2)}
+            log(f"{table:<18} {n:>10} rows  {dt:7.2f}s  {n / dt if dt else 0:>10.0f} rows/s")
+        for conn in shard_conns:
+            conn.execute("INSERT OR REPLACE INTO user_rev(user_id, rev, profile_rev) SELECT user_id, 1, 1 FROM users")
+        server.rebuild_market_stats(conns[path])
+        for conn, sqls in triggers.items():
+            for sql in sqls:
+                conn.execute(sql)
+        for conn in conns.values():
+            conn.execute("COMMIT")
+    except BaseException:
+        for conn in conns.values():
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+        raise
+    finally:
+        for conn in conns.values():
+            conn.execute("PRAGMA locking_mode=NORMAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.close()
+    stats["total_seconds"] = round(time.perf_counter() - t_all, 2)
+    return stats
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--db", required=True, help="output database (it and its shard files must not exist unless --force)")
+    ap.add_argument("--users", type=int, default=100_000)
+    ap.add_argument("--inventory", type=int, default=1_000_000, help="inventory inserts (duplicates merge into qty)")
+    ap.add_argument("--listings", type=int, default=200_000, help="market_listings rows")
+    ap.add_argument("--active-share", type=float, default=0.2, help="share of listings still active")
+    ap.add_argument("--trades", type=int, default=50_000, help="p2p_player_trades rows")
+    ap.add_argument("--tx", type=int, default=2_000_000, help="tx_log rows")
+    ap.add_argument("--purchases", type=int, default=10_000)
+    ap.add_argument("--vip-share", type=float, default=0.05)
+    ap.add_argument("--days", type=int, default=30, help="timestamps are spread over this many days")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--force", action="store_true", help="overwrite --db and its shard files if they exist")
+    args = ap.parse_args(argv)
+
+    path = os.path.abspath(args.db)
+    # server reads DB_PATH on import; populate() creates the schema
+    os.environ["DB_PATH"] = path
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import server
+
+    # with DB_SHARDS > 1 the per-user rows live in game.shard{i}.db next to --db
+    files = [p + suffix for p in sorted(set(server.shard_paths()) | {path})
+             for suffix in ("", "-wal", "-shm", "-journal")]
+    existing = [p for p in files if os.path.exists(p)]
+    if existing:
+        if not args.force:
+            raise SystemExit(f"{', '.join(existing)} exist(s), pass --force to overwrite")
+        for p in existing:
+            os.remove(p)
+
+    stats = populate(path, server.PLAYERS, server.CLUBS, users=args.users, inventory=args.inventory,
+                     listings=args.listings, trades=args.trades, tx=args.tx, purchases=args.purchases,
+                     vip_share=args.vip_share, active_share=args.active_share, days=args.days, seed=args.seed)
+    size_mb = sum(os.path.getsize(p) for p in set(server.shard_paths()) | {path}) / 1e6
+    print(f"done in {stats['total_seconds']}s, {size_mb:.1f} MB -> {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Bulk grant of coins / packs / VIP days (event rewards, outage compensation).
+
+    python grant.py --job outage-0412 --coins 500 --packs 1 --users ids.txt
+    python grant.py --job vip-weekend --vip-days 3 --all
+    python grant.py --job promo --product pack_big --users -        # ids on stdin
+    python grant.py --job outage-0412 --status
+
+--users is a file with one user id per line (anything after the id is
+ignored). Users get the grant shard by shard in transactions of --chunk
+users; an interrupted run is resumed by running the same command again:
+users the job already reached are skipped. A job name is bound to its grant,
+reusing it with a different one is refused.
+"""
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import server  # noqa: E402
+
+
+def read_ids(path):
+    f = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    try:
+        for line in f:
+            token = (line.split(",")[0].split() or [""])[0]
+            if token.isdigit():
+                yield int(token)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def all_user_ids():
+    for path in server.shard_paths():
+        conn = server.connect(path)
+        for (uid,) in conn.execute("SELECT user_id FROM users ORDER BY user_id"):
+            yield uid
+        conn.close()
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--job", required=True, help="job name; also the tx_log note")
+    src = ap.add_mutually_exclusive_group()
+    src.add_argument("--users", help="file with user ids, - for stdin")
+    src.add_argument("--all", action="store_true", help="every existing user")
+    src.add_argument("--status", action="store_true", help="show the job and how many users it reached")
+    ap.add_argument("--coins", type=int, default=0)
+    ap.add_argument("--packs", type=int, default=0)
+    ap.add_argument("--vip-days", type=int, default=0)
+    ap.add_argument("--product", default="", help=f"grant of a CATALOG item: {', '.join(server.CATALOG)}")
+    ap.add_argument("--chunk", type=int, default=server.GRANT_CHUNK, help="users per transaction")
+    args = ap.parse_args(argv)
+
+    if server.pending_schema():
+        raise SystemExit("database schema is behind, run `python migrate.py` first")
+    if args.status:
+        status = server.grant_job_status(args.job)
+        if not status:
+            raise SystemExit(f"no job {args.job!r}")
+        print(json.dumps(status, ensure_ascii=False))
+        return
+    if not (args.users or args.all):
+        ap.error("one of --users, --all or --status is required")
+
+    spec = {k: v for k, v in (("coins", args.coins), ("packs", args.packs), ("vip_days", args.vip_days)) if v}
+    if args.product:
+        if args.product not in server.CATALOG or spec:
+            ap.error("--product takes a CATALOG key and no --coins/--packs/--vip-days")
+        spec = args.product
+    try:
+        grant = server.parse_grant(spec or {})
+    except ValueError as e:
+        ap.error(str(e))
+
+    ids = all_user_ids() if args.all else read_ids(args.users)
+    try:
+        stats = server.bulk_grant(args.job, grant, list(ids), chunk=max(1, min(args.chunk, 30000)))
+    except ValueError as e:
+        raise SystemExit(str(e))
+    print(json.dumps(stats, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+"""gunicorn settings picked up from the working directory (`gunicorn server:app`)."""
+import os
+import sys
+import subprocess
+
+
+def on_starting(server):
+    # Migrate once, in the master, before any worker imports the app. A separate
+    # process so the master itself never opens the databases it forks from.
+    subprocess.run([sys.executable, "migrate.py"], cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+
+
+def post_worker_init(worker):
+    # each worker finishes/aborts transfers a crashed worker left behind
+    import server
+    server.start_recovery()
@@ -0,0 +1,41 @@
+"""Apply schema migrations (server.MIGRATIONS) to DB_PATH and every shard file.
+
+    python migrate.py            # before starting the app / in the deploy step
+    python migrate.py --status   # version of every file, exit 1 if any is behind
+
+Workers never run DDL: they start against whatever is on disk and /health
+answers 503 schema_outdated until this has been run. gunicorn.conf.py runs it
+once in the master before the workers are forked.
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import server  # noqa: E402
+
+
+def status():
+    behind = 0
+    for path, scopes in server.schema_files().items():
+        version = server.schema_version(path)
+        behind += version < server.SCHEMA_VERSION
+        print(f"{path} ({'+'.join(sorted(scopes))}): {version}/{server.SCHEMA_VERSION}")
+    return behind
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--status", action="store_true", help="only print versions")
+    args = ap.parse_args(argv)
+
+    if args.status:
+        raise SystemExit(1 if status() else 0)
+    t0 = time.perf_counter()
+    server.migrate()
+    print(f"schema {server.SCHEMA_VERSION} in {time.perf_counter() - t0:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,28 @@
 import os
+import re
+import sys
 import json
 import time
+import queue
+import random
 import sqlite3
+import cProfile
+import functools
+import collections
+import mimetypes
+import contextlib
+import threading
 import urllib.request
 import urllib.parse
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, has_request_context
+from flask.json.provider import DefaultJSONProvider
+
+BOOT_STARTED = time.perf_counter()
+
+try:
+    import orjson
+except ImportError:  # optional speedup, stdlib json is used otherwise
+    orjson = None
 
 # =========================
 # Config (ENV)
@@ -54,54 +72,508 @@ PLAYERS_BY_ID = {int(p["id"]): p for p in PLAYERS if "id" in p}
 CLUBS_BY_ID = {int(c["id"]): c for c in CLUBS if "id" in c}
 
 # =========================
-# DB helpers
+# Static assets (built by build_assets.py)
 # =========================
-DB_PATH = "game.db"
+ASSET_DIR = os.path.join(app.root_path, os.environ.get("ASSET_DIR", "dist"))
+ASSET_MANIFEST = load_json_file(os.path.join(ASSET_DIR, "manifest.json"), {})
+IMAGE_THUMB = "192"  # card images are shown at ~96px, 2x for retina
+IMMUTABLE = "public, max-age=31536000, immutable"
 
-def db():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+
+def image_url(kind: str, name: str):
+    """Thumbnail / fingerprinted URL of a player or club image, None if there is no such file."""
+    if not name:
+        return None
+    entry = ASSET_MANIFEST.get("images", {}).get(f"{kind}/{name}")
+    if entry:
+        return "/web/assets/" + (entry["webp"].get(IMAGE_THUMB) or entry["src"])
+    if os.path.isfile(os.path.join(app.root_path, "static", kind, name)):
+        return f"/web/images/{kind}/{name}"
+    return None
+
+
+def send_asset(rel: str, cache_control: str):
+    """File from ASSET_DIR, precompressed variant if the client accepts it."""
+    mimetype = mimetypes.guess_type(rel)[0]
+    path, encoding = rel, None
+    for enc, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if enc in ASSET_MANIFEST.get("compressed", {}).get(rel, ()) and request.accept_encodings[enc]:
+            path, encoding = rel + suffix, enc
+            break
+    # download_name: the Content-Disposition filename is the logical one, not index.html.br
+    resp = send_from_directory(ASSET_DIR, path, mimetype=mimetype, download_name=os.path.basename(rel))
+    if encoding:
+        resp.headers["Content-Encoding"] = encoding
+    resp.headers["Vary"] = "Accept-Encoding"
+    resp.headers["Cache-Control"] = cache_control
+    return resp
+
+
+for p in PLAYERS:
+    url = image_url("players", p.get("image"))
+    if url:
+        p["image_url"] = url
+for c in CLUBS:
+    url = image_url("clubs", c.get("logo"))
+    if url:
+        c["logo_url"] = url
+
+# =========================
+# JSON
+# =========================
+class FastJSONProvider(DefaultJSONProvider):
+    """orjson when installed, otherwise stdlib json without key sorting / ascii escaping."""
+    ensure_ascii = False
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None or self._app.debug:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(encode_json(obj), mimetype=self.mimetype)
+
+
+app.json = FastJSONProvider(app)
+
+
+_stdlib_encoder = json.JSONEncoder(default=app.json.default, ensure_ascii=False, separators=(",", ":"))
+
+
+def encode_json(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, default=app.json.default, option=orjson.OPT_NON_STR_KEYS)
+    return _stdlib_encoder.encode(obj).encode("utf-8")
+
+
+def raw_json_response(body: bytes, status: int = 200):
+    return app.response_class(body, status=status, mimetype="application/json")
+
+
+def join_json_object(head: dict, **fragments) -> bytes:
+    """Encode `head` and append already-encoded values: {...head, "key": <fragment>}."""
+    body = encode_json(head)
+    extra = b",".join(b'"' + k.encode() + b'":' + v for k, v in fragments.items())
+    if not extra:
+        return body
+    return body[:-1] + (b"," if len(body) > 2 else b"") + extra + b"}"
+
+
+# Players/clubs never change at runtime, encode them once instead of per response.
+PLAYER_JSON = {pid: encode_json(p) for pid, p in PLAYERS_BY_ID.items()}
+PLAYERS_JSON = encode_json(PLAYERS)
+CLUBS_JSON = encode_json(CLUBS)
+
+
+def encode_rows_with_player(rows, skip_unknown=True) -> bytes:
+    """JSON array of row objects, each extended with its "player".
+
+    orjson encodes the small player dicts faster than Python can splice bytes
+    (see `bench.py --serialization`), so cached fragments are only used with stdlib json.
+    """
+    if orjson is not None:
+        items = []
+        for r in rows:
+            p = PLAYERS_BY_ID.get(int(r["player_id"]))
+            if p is None and skip_unknown:
+                continue
+            items.append({**dict(r), "player": p})
+        return orjson.dumps(items)
+    out = []
+    for r in rows:
+        frag = PLAYER_JSON.get(int(r["player_id"]))
+        if frag is None:
+            if skip_unknown:
+                continue
+            frag = b"null"
+        out.append(encode_json(dict(r))[:-1] + b',"player":' + frag + b"}")
+    return b"[" + b",".join(out) + b"]"
+
+# =========================
+# Instrumentation (opt-in: METRICS=1)
+# =========================
+METRICS_ENABLED = os.environ.get("METRICS", "") == "1"
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", "0") or 0)  # 0 = never dump profiles
+PROFILE_SAMPLE = float(os.environ.get("PROFILE_SAMPLE", "0.01") or 0)  # share of requests run under cProfile
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+SQL_TRACE_ENABLED = os.environ.get("SQL_TRACE", "") == "1"
+SQL_SLOW_MS = float(os.environ.get("SQL_SLOW_MS", "50") or 0)
+SQL_SLOW_LOG = os.environ.get("SQL_SLOW_LOG", "slow_queries.log")
+
+REQUEST_COUNTERS = ("db_connections", "db_statements", "db_commits", "db_rows_read", "tg_calls")
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_req_local = threading.local()
+_metrics_lock = threading.Lock()
+_profile_lock = threading.Lock()  # cProfile can only run one profiler at a time
+_endpoint_metrics = {}  # (method, rule) -> aggregate dict
+_status_counts = {}  # (method, rule, status) -> n
+_global_counters = {"slow_requests": 0, "profiles_dumped": 0}
+_sql_lock = threading.Lock()
+_sql_stats = {}  # normalized sql -> {"count", "seconds", "max"}
+
+
+def count(name: str, n: int = 1):
+    stats = getattr(_req_local, "stats", None)
+    if stats is not None:
+        stats[name] += n
+
+
+_SQL_STRING = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUMBER = re.compile(r"(?<![\w?])-?\d+(?:\.\d+)?\b")
+_SQL_IN_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)", re.IGNORECASE)  # not VALUES(?,?)
+_SQL_SPACE = re.compile(r"\s+")
+_SQL_EXPLAINABLE = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|REPLACE|WITH)\b", re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_sql(sql: str) -> str:
+    sql = _SQL_STRING.sub("?", sql)
+    sql = _SQL_NUMBER.sub("?", sql)
+    sql = _SQL_IN_LIST.sub("IN (...)", sql)
+    return _SQL_SPACE.sub(" ", sql).strip()
+
+
+def record_sql(sql: str, seconds: float, executed: bool):
+    key = normalize_sql(sql)
+    with _sql_lock:
+        st = _sql_stats.get(key)
+        if st is None:
+            st = _sql_stats[key] = {"count": 0, "seconds": 0.0, "max": 0.0}
+        if executed:
+            st["count"] += 1
+        st["seconds"] += seconds
+        st["max"] = max(st["max"], seconds)
+
+
+def log_slow_sql(conn, sql: str, params, seconds: float):
+    plan = []
+    if params is not None and _SQL_EXPLAINABLE.match(sql):
+        try:
+            # plain cursor: the plan lookup must not be traced itself
+            cur = sqlite3.Connection.cursor(conn)
+            cur.execute("EXPLAIN QUERY PLAN " + sql, params)
+            plan = [r[-1] for r in cur.fetchall()]
+        except sqlite3.Error as e:
+            plan = [f"explain failed: {e}"]
+    entry = {"ts": int(time.time()), "ms": round(seconds * 1000, 3), "sql": normalize_sql(sql), "plan": plan}
+    if has_request_context():
+        entry["endpoint"] = f"{request.method} {request.path}"
+    with _sql_lock:
+        with open(SQL_SLOW_LOG, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # Time spent in fetch* is added to the statement that produced the rows,
+    # SQLite does most of a SELECT's work while stepping through results.
+    _trace = None  # [sql, params, seconds, already_logged]
+
+    def _timed(self, fn, *args):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            dt = time.perf_counter() - t0
+            tr = self._trace
+            if tr is not None:
+                tr[2] += dt
+                record_sql(tr[0], dt, executed=False)
+                if not tr[3] and tr[2] * 1000 >= SQL_SLOW_MS:
+                    tr[3] = True
+                    log_slow_sql(self.connection, tr[0], tr[1], tr[2])
+
+    def _traced_execute(self, method, sql, params, explain_params):
+        t0 = time.perf_counter()
+        try:
+            return method(sql, params)
+        finally:
+            dt = time.perf_counter() - t0
+            record_sql(sql, dt, executed=True)
+            self._trace = [sql, explain_params, dt, False]
+            if dt * 1000 >= SQL_SLOW_MS:
+                self._trace[3] = True
+                log_slow_sql(self.connection, sql, explain_params, dt)
+
+    def execute(self, sql, params=()):
+        count("db_statements")
+        if not SQL_TRACE_ENABLED:
+            return super().execute(sql, params)
+        return self._traced_execute(super().execute, sql, params, params)
+
+    def executemany(self, sql, seq):
+        count("db_statements")
+        if not SQL_TRACE_ENABLED:
+            return super().executemany(sql, seq)
+        return self._traced_execute(super().executemany, sql, seq, None)
+
+    def fetchone(self):
+        row = self._timed(super().fetchone) if SQL_TRACE_ENABLED else super().fetchone()
+        if row is not None:
+            count("db_rows_read")
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._timed(super().fetchmany, size) if SQL_TRACE_ENABLED else super().fetchmany(size)
+        count("db_rows_read", len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall) if SQL_TRACE_ENABLED else super().fetchall()
+        count("db_rows_read", len(rows))
+        return rows
+
+    def __next__(self):
+        row = self._timed(super().__next__) if SQL_TRACE_ENABLED else super().__next__()
+        count("db_rows_read")
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        count("db_connections")
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection.execute* create their cursor in C, bypassing cursor()
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+    def commit(self):
+        count("db_commits")
+        return super().commit()
+
+
+def _metrics_begin():
+    _req_local.stats = dict.fromkeys(REQUEST_COUNTERS, 0)
+    _req_local.started = time.perf_counter()
+    _req_local.profiler = None
+    if PROFILE_SLOW_MS > 0 and random.random() < PROFILE_SAMPLE and _profile_lock.acquire(blocking=False):
+        _req_local.profiler = cProfile.Profile()
+        _req_local.profiler.enable()
+
+
+def _metrics_end(response):
+    stats = getattr(_req_local, "stats", None)
+    if stats is None:
+        return response
+    elapsed = time.perf_counter() - _req_local.started
+    profiler = _req_local.profiler
+    _req_local.stats = None
+    _req_local.profiler = None
+
+    rule = request.url_rule.rule if request.url_rule else "unmatched"
+    key = (request.method, rule)
+    with _metrics_lock:
+        agg = _endpoint_metrics.get(key)
+        if agg is None:
+            agg = _endpoint_metrics[key] = {"count": 0, "sum": 0.0, "buckets": [0] * len(DURATION_BUCKETS),
+                                            **dict.fromkeys(REQUEST_COUNTERS, 0)}
+        agg["count"] += 1
+        agg["sum"] += elapsed
+        for i, le in enumerate(DURATION_BUCKETS):
+            if elapsed <= le:
+                agg["buckets"][i] += 1
+        for name in REQUEST_COUNTERS:
+            agg[name] += stats[name]
+        skey = (request.method, rule, response.status_code)
+        _status_counts[skey] = _status_counts.get(skey, 0) + 1
+        if PROFILE_SLOW_MS > 0 and elapsed * 1000 >= PROFILE_SLOW_MS:
+            _global_counters["slow_requests"] += 1
+
+    if profiler is not None:
+        profiler.disable()
+        _profile_lock.release()
+        if elapsed * 1000 >= PROFILE_SLOW_MS:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            name = f"{int(time.time() * 1000)}_{request.method}_{rule.strip('/').replace('/', '_') or 'root'}.prof"
+            profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+            with _metrics_lock:
+                _global_counters["profiles_dumped"] += 1
+    return response
+
+
+def _prom_escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _prom_labels(**labels):
+    return "{" + ",".join(f'{k}="{_prom_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def render_metrics() -> str:
+    out = []
+    with _metrics_lock:
+        endpoints = sorted(_endpoint_metrics.items())
+        statuses = sorted(_status_counts.items())
+        counters = dict(_global_counters)
+
+    out.append("# HELP football_request_duration_seconds Request wall time.")
+    out.append("# TYPE football_request_duration_seconds histogram")
+    for (method, rule), agg in endpoints:
+        for le, n in zip(DURATION_BUCKETS, agg["buckets"]):
+            out.append(f"football_request_duration_seconds_bucket{_prom_labels(method=method, endpoint=rule, le=le)} {n}")
+        out.append(f"football_request_duration_seconds_bucket{_prom_labels(method=method, endpoint=rule, le='+Inf')} "
+                   f"{agg['count']}")
+        out.append(f"football_request_duration_seconds_sum{_prom_labels(method=method, endpoint=rule)} {agg['sum']:.6f}")
+        out.append(f"football_request_duration_seconds_count{_prom_labels(method=method, endpoint=rule)} {agg['count']}")
+
+    out.append("# HELP football_requests_total Requests by status code.")
+    out.append("# TYPE football_requests_total counter")
+    for (method, rule, status), n in statuses:
+        out.append(f"football_requests_total{_prom_labels(method=method, endpoint=rule, status=status)} {n}")
+
+    for name in REQUEST_COUNTERS:
+        out.append(f"# HELP football_{name}_total Summed over requests.")
+        out.append(f"# TYPE football_{name}_total counter")
+        for (method, rule), agg in endpoints:
+            out.append(f"football_{name}_total{_prom_labels(method=method, endpoint=rule)} {agg[name]}")
+
+    for name, n in sorted(counters.items()):
+        out.append(f"# TYPE football_{name}_total counter")
+        out.append(f"football_{name}_total {n}")
+
+    with _metrics_lock:
+        admissions = sorted(_admit_counts.items())
+    out.append("# HELP football_admission_total Requests answered 429 (rejected, busy) or coalesced by per_user_admission.")
+    out.append("# TYPE football_admission_total counter")
+    for (name, outcome), n in admissions:
+        out.append(f"football_admission_total{_prom_labels(endpoint=name, outcome=outcome)} {n}")
+
+    out.append("# HELP football_boot_seconds Time this worker spent importing the app.")
+    out.append("# TYPE football_boot_seconds gauge")
+    out.append(f"football_boot_seconds {BOOT_SECONDS:.6f}")
+
+    if SQL_TRACE_ENABLED:
+        with _sql_lock:
+            queries = sorted(_sql_stats.items(), key=lambda kv: -kv[1]["seconds"])
+        out.append("# HELP football_sql_seconds Time spent per normalized statement (execute + fetch).")
+        out.append("# TYPE football_sql_seconds summary")
+        for sql, st in queries:
+            q = _prom_escape(sql)
+            out.append(f'football_sql_seconds_sum{{query="{q}"}} {st["seconds"]:.6f}')
+            out.append(f'football_sql_seconds_count{{query="{q}"}} {st["count"]}')
+        out.append("# TYPE football_sql_max_seconds gauge")
+        for sql, st in queries:
+            q = _prom_escape(sql)
+            out.append(f'football_sql_max_seconds{{query="{q}"}} {st["max"]:.6f}')
+    return "\n".join(out) + "\n"
+
+
+if METRICS_ENABLED:
+    app.before_request(_metrics_begin)
+    app.after_request(_metrics_end)
+
+# =========================
+# DB helpers
+# =========================
+DB_PATH = os.environ.get("DB_PATH", "game.db")
+# Per-user tables are split over DB_SHARDS files by user_id so that writes for
+# different users don't all queue on one SQLite write lock. Shared tables
+# (market, p2p trades, purchases, transfers) always live in DB_PATH; with
+# DB_SHARDS=1 (default) everything stays in DB_PATH as before.
+DB_SHARDS = max(1, as_int(os.environ.get("DB_SHARDS"), 1))
+USER_TABLES = ("users", "inventory", "user_level", "vip", "tx_log", "transfer_steps", "user_rev", "grant_done",
+               "action_leases")
+
+def connect(path: str):
+    conn = sqlite3.connect(path, check_same_thread=False,
+                           factory=InstrumentedConnection if METRICS_ENABLED or SQL_TRACE_ENABLED
+                           else sqlite3.Connection)
     conn.row_factory = sqlite3.Row
     return conn
 
-def init_db():
-    conn = db()
-    cur = conn.cursor()
+@functools.lru_cache(maxsize=32)
+def _shard_paths(db_path: str, n: int):
+    if n <= 1:
+        return (db_path,)
+    base, ext = os.path.splitext(db_path)
+    return tuple(f"{base}.shard{i}{ext}" for i in range(n))
 
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        username TEXT,
-        club_id INTEGER DEFAULT 0,
-        club_name TEXT DEFAULT '',
-        coins INTEGER NOT NULL DEFAULT 0,
-        last_daily INTEGER NOT NULL DEFAULT 0,
-        created_at INTEGER DEFAULT (strftime('%s','now'))
-    )
-    """)
+def shard_paths(n: int = None):
+    return _shard_paths(DB_PATH, DB_SHARDS if n is None else n)
 
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS inventory (
-        user_id INTEGER NOT NULL,
-        player_id INTEGER NOT NULL,
-        qty INTEGER NOT NULL DEFAULT 0,
-        PRIMARY KEY (user_id, player_id)
-    )
-    """)
+def shard_index(user_id: int, n: int = None) -> int:
+    n = DB_SHARDS if n is None else n
+    return int(user_id) % n if n > 1 else 0
 
-    cur.execute("""
+def db():
+    """Connection to the shared tables."""
+    return connect(DB_PATH)
+
+def udb(user_id: int):
+    """Connection to the shard holding `user_id`'s rows."""
+    return connect(shard_paths()[shard_index(user_id)])
+
+# GET handlers read through pooled query_only connections. With WAL, readers
+# never take the write lock and don't block (or wait for) writers.
+READ_POOL_SIZE = max(1, as_int(os.environ.get("READ_POOL_SIZE"), 8))
+_read_pools = {}  # (pid, path) -> LifoQueue of idle reader connections
+_read_pools_lock = threading.Lock()
+
+def _read_pool(path: str):
+    key = (os.getpid(), path)  # never reuse connections inherited over fork
+    pool = _read_pools.get(key)
+    if pool is None:
+        with _read_pools_lock:
+            pool = _read_pools.setdefault(key, queue.LifoQueue(maxsize=READ_POOL_SIZE))
+    return pool
+
+@contextlib.contextmanager
+def read_conn(path: str):
+    pool = _read_pool(path)
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = connect(path)
+        conn.execute("PRAGMA query_only=1")
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+def rdb():
+    """Read-only pooled connection to the shared tables (use as a context manager)."""
+    return read_conn(DB_PATH)
+
+def urdb(user_id: int):
+    """Read-only pooled connection to `user_id`'s shard (use as a context manager)."""
+    return read_conn(shard_paths()[shard_index(user_id)])
+
+SHARED_SCHEMA = [
+    """
     CREATE TABLE IF NOT EXISTS market_listings (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         seller_id INTEGER NOT NULL,
         player_id INTEGER NOT NULL,
         price INTEGER NOT NULL,
-        status TEXT NOT NULL, -- active/sold/canceled
+        status TEXT NOT NULL, -- active/pending/sold/canceled
         created_at INTEGER DEFAULT (strftime('%s','now')),
         sold_at INTEGER
     )
-    """)
-
+    """,
     # P2P player trades (escrow)
-    cur.execute("""
+    """
     CREATE TABLE IF NOT EXISTS p2p_player_trades (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         seller_id INTEGER NOT NULL,
@@ -109,14 +581,71 @@ def init_db():
         player_id INTEGER NOT NULL,
         price INTEGER NOT NULL,
         fee INTEGER NOT NULL,
-        status TEXT NOT NULL, -- pending/accepted/canceled
+        status TEXT NOT NULL, -- pending/accepting/accepted/canceled
         created_at INTEGER DEFAULT (strftime('%s','now')),
         accepted_at INTEGER
     )
-    """)
+    """,
+    # Stars purchase dedupe (safe)
+    """
+    CREATE TABLE IF NOT EXISTS purchases (
+        tg_charge_id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        payload TEXT,
+        created_at INTEGER DEFAULT (strftime('%s','now'))
+    )
+    """,
+    # Live events for /api/events, see "Live events" below
+    """
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        data TEXT NOT NULL,
+        user_ids TEXT, -- NULL: everyone, else comma separated recipients
+        origin TEXT, -- pid of the publishing worker
+        created_at INTEGER DEFAULT (strftime('%s','now'))
+    )
+    """,
+    # Buyer -> seller transfers journal, see "Transfers" below
+    """
+    CREATE TABLE IF NOT EXISTS transfers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL, -- market_buy/p2p_player
+        ref_id INTEGER NOT NULL, -- listing id / trade id
+        buyer_id INTEGER NOT NULL,
+        seller_id INTEGER NOT NULL,
+        player_id INTEGER NOT NULL,
+        price INTEGER NOT NULL,
+        fee INTEGER NOT NULL DEFAULT 0,
+        state TEXT NOT NULL, -- reserved/debited/done/aborted
+        created_at INTEGER DEFAULT (strftime('%s','now')),
+        updated_at INTEGER DEFAULT (strftime('%s','now'))
+    )
+    """,
+]
 
+USER_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        club_id INTEGER DEFAULT 0,
+        club_name TEXT DEFAULT '',
+        coins INTEGER NOT NULL DEFAULT 0,
+        last_daily INTEGER NOT NULL DEFAULT 0,
+        created_at INTEGER DEFAULT (strftime('%s','now'))
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS inventory (
+        user_id INTEGER NOT NULL,
+        player_id INTEGER NOT NULL,
+        qty INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, player_id)
+    )
+    """,
     # Transactions log
-    cur.execute("""
+    """
     CREATE TABLE IF NOT EXISTS tx_log (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER NOT NULL,
@@ -125,83 +654,328 @@ def init_db():
         note TEXT,
         created_at INTEGER DEFAULT (strftime('%s','now'))
     )
-    """)
-
+    """,
     # Level/XP
-    cur.execute("""
+    """
     CREATE TABLE IF NOT EXISTS user_level (
         user_id INTEGER PRIMARY KEY,
         xp INTEGER NOT NULL DEFAULT 0,
         level INTEGER NOT NULL DEFAULT 1
     )
-    """)
-
+    """,
     # VIP
-    cur.execute("""
+    """
     CREATE TABLE IF NOT EXISTS vip (
         user_id INTEGER PRIMARY KEY,
         vip_until INTEGER NOT NULL DEFAULT 0
     )
-    """)
+    """,
+    # Transfer steps applied on this shard (idempotency marks)
+    """
+    CREATE TABLE IF NOT EXISTS transfer_steps (
+        transfer_id INTEGER NOT NULL,
+        step TEXT NOT NULL, -- debit/credit/deliver
+        user_id INTEGER NOT NULL,
+        created_at INTEGER DEFAULT (strftime('%s','now')),
+        PRIMARY KEY (transfer_id, step)
+    )
+    """,
+    # Per-user change counter for /api/sync
+    """
+    CREATE TABLE IF NOT EXISTS user_rev (
+        user_id INTEGER PRIMARY KEY,
+        rev INTEGER NOT NULL DEFAULT 0,
+        profile_rev INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+]
+
+# Any write to the synced tables bumps user_rev.rev, so /api/sync can't miss a
+# change whichever code path made it (helpers, transfer steps, gen_data, ...).
+# inventory.rev / user_rev.profile_rev remember the rev of their last change.
+_BUMP_PROFILE = """
+    INSERT INTO user_rev(user_id, rev, profile_rev) VALUES(NEW.user_id, 1, 1)
+    ON CONFLICT(user_id) DO UPDATE SET rev = rev + 1, profile_rev = rev + 1;
+"""
+_BUMP_INVENTORY = """
+    INSERT INTO user_rev(user_id, rev) VALUES(NEW.user_id, 1)
+    ON CONFLICT(user_id) DO UPDATE SET rev = rev + 1;
+    UPDATE inventory SET rev = (SELECT rev FROM user_rev WHERE user_id = NEW.user_id)
+    WHERE user_id = NEW.user_id AND player_id = NEW.player_id;
+"""
+SYNC_SCHEMA = [
+    "CREATE INDEX IF NOT EXISTS idx_inventory_rev ON inventory(user_id, rev)",
+    f"CREATE TRIGGER IF NOT EXISTS inventory_rev_ins AFTER INSERT ON inventory BEGIN {_BUMP_INVENTORY} END",
+    f"CREATE TRIGGER IF NOT EXISTS inventory_rev_upd AFTER UPDATE OF qty ON inventory BEGIN {_BUMP_INVENTORY} END",
+    f"CREATE TRIGGER IF NOT EXISTS users_rev_ins AFTER INSERT ON users BEGIN {_BUMP_PROFILE} END",
+    f"CREATE TRIGGER IF NOT EXISTS users_rev_upd AFTER UPDATE OF username, club_id, club_name, coins, last_daily, "
+    f"pack_credits ON users BEGIN {_BUMP_PROFILE} END",
+    f"CREATE TRIGGER IF NOT EXISTS user_level_rev_ins AFTER INSERT ON user_level BEGIN {_BUMP_PROFILE} END",
+    f"CREATE TRIGGER IF NOT EXISTS user_level_rev_upd AFTER UPDATE ON user_level BEGIN {_BUMP_PROFILE} END",
+    f"CREATE TRIGGER IF NOT EXISTS vip_rev_ins AFTER INSERT ON vip BEGIN {_BUMP_PROFILE} END",
+    f"CREATE TRIGGER IF NOT EXISTS vip_rev_upd AFTER UPDATE ON vip BEGIN {_BUMP_PROFILE} END",
+]
+
+# Price discovery for /api/market/stats, kept current by triggers on
+# market_listings so no request ever aggregates over the listings themselves.
+# market_stats: one row per player (active asks, cheapest ask, last sale);
+# market_stats_hourly: sales per player per hour, pruned past MARKET_STATS_KEEP.
+MARKET_STATS_KEEP = 7 * 86400
+_SOLD_HOUR = "(CAST(COALESCE(NEW.sold_at, strftime('%s','now')) AS INTEGER) / 3600 * 3600)"
+_ASK_ADD = """
+    INSERT INTO market_stats(player_id, active, min_ask) VALUES(NEW.player_id, 1, NEW.price)
+    ON CONFLICT(player_id) DO UPDATE SET
+        active = active + 1, min_ask = MIN(COALESCE(min_ask, excluded.min_ask), excluded.min_ask);
+"""
+_ASK_DROP = """
+    UPDATE market_stats SET
+        active = active - 1,
+        min_ask = CASE WHEN OLD.price > min_ask THEN min_ask ELSE
+            (SELECT MIN(price) FROM market_listings WHERE player_id = OLD.player_id AND status = 'active') END
+    WHERE player_id = OLD.player_id;
+"""
+_SALE = f"""
+    INSERT INTO market_stats(player_id, sales, last_price, last_sold_at)
+    VALUES(NEW.player_id, 1, NEW.price, CAST(COALESCE(NEW.sold_at, strftime('%s','now')) AS INTEGER))
+    ON CONFLICT(player_id) DO UPDATE SET
+        sales = sales + 1,
+        last_price = CASE WHEN excluded.last_sold_at >= COALESCE(last_sold_at, 0) THEN excluded.last_price ELSE last_price END,
+        last_sold_at = MAX(COALESCE(last_sold_at, 0), excluded.last_sold_at);
+    INSERT INTO market_stats_hourly(player_id, hour, sales, volume) VALUES(NEW.player_id, {_SOLD_HOUR}, 1, NEW.price)
+    ON CONFLICT(player_id, hour) DO UPDATE SET sales = sales + 1, volume = volume + excluded.volume;
+    DELETE FROM market_stats_hourly WHERE player_id = NEW.player_id AND hour < {_SOLD_HOUR} - {MARKET_STATS_KEEP};
+"""
+MARKET_STATS_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS market_stats (
+        player_id INTEGER PRIMARY KEY,
+        active INTEGER NOT NULL DEFAULT 0, -- listings with status 'active'
+        min_ask INTEGER,
+        sales INTEGER NOT NULL DEFAULT 0, -- all time
+        last_price INTEGER,
+        last_sold_at INTEGER
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS market_stats_hourly (
+        player_id INTEGER NOT NULL,
+        hour INTEGER NOT NULL, -- unix time of the hour start
+        sales INTEGER NOT NULL DEFAULT 0,
+        volume INTEGER NOT NULL DEFAULT 0, -- coins
+        PRIMARY KEY (player_id, hour)
+    ) WITHOUT ROWID
+    """,
+    # cheapest active ask after the current one is sold/canceled: an index seek
+    "CREATE INDEX IF NOT EXISTS idx_market_player_ask ON market_listings(player_id, status, price)",
+    f"CREATE TRIGGER IF NOT EXISTS market_stats_ins_active AFTER INSERT ON market_listings "
+    f"WHEN NEW.status = 'active' BEGIN {_ASK_ADD} END",
+    f"CREATE TRIGGER IF NOT EXISTS market_stats_ins_sold AFTER INSERT ON market_listings "
+    f"WHEN NEW.status = 'sold' BEGIN {_SALE} END",
+    f"CREATE TRIGGER IF NOT EXISTS market_stats_ask_add AFTER UPDATE OF status ON market_listings "
+    f"WHEN NEW.status = 'active' AND OLD.status <> 'active' BEGIN {_ASK_ADD} END",
+    f"CREATE TRIGGER IF NOT EXISTS market_stats_ask_drop AFTER UPDATE OF status ON market_listings "
+    f"WHEN OLD.status = 'active' AND NEW.status <> 'active' BEGIN {_ASK_DROP} END",
+    f"CREATE TRIGGER IF NOT EXISTS market_stats_sale AFTER UPDATE OF status ON market_listings "
+    f"WHEN NEW.status = 'sold' AND OLD.status <> 'sold' BEGIN {_SALE} END",
+]
+
+# Bulk grants (see bulk_grant): the job's spec in the shared file, and per shard
+# the users it already reached, written in the same transaction as the grant.
+GRANT_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS grant_jobs (
+        job TEXT PRIMARY KEY,
+        grant_spec TEXT NOT NULL, -- JSON, same shape as CATALOG "grant"
+        created_at INTEGER DEFAULT (strftime('%s','now')),
+        finished_at INTEGER
+    )
+    """,
+]
+GRANT_USER_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS grant_done (
+        job TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        PRIMARY KEY (job, user_id)
+    )
+    """,
+]
 
-    # Stars purchase dedupe (safe)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS purchases (
-        tg_charge_id TEXT PRIMARY KEY,
+# per_user_admission across processes: a row while (user_id, name) is running
+LEASE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS action_leases (
         user_id INTEGER NOT NULL,
-        payload TEXT,
-        created_at INTEGER DEFAULT (strftime('%s','now'))
+        name TEXT NOT NULL,
+        expires REAL NOT NULL,
+        PRIMARY KEY (user_id, name)
     )
+    """,
+]
+
+def rebuild_market_stats(conn):
+    """Recompute market_stats* from market_listings (first migration, bulk loads)."""
+    since = int(time.time()) // 3600 * 3600 - MARKET_STATS_KEEP
+    conn.execute("DELETE FROM market_stats")
+    conn.execute("DELETE FROM market_stats_hourly")
+    conn.execute("""
+        INSERT INTO market_stats(player_id, active, min_ask, sales)
+        SELECT player_id, SUM(status = 'active'), MIN(CASE WHEN status = 'active' THEN price END), SUM(status = 'sold')
+        FROM market_listings GROUP BY player_id
     """)
+    conn.execute("""
+        UPDATE market_stats SET (last_price, last_sold_at) = (
+            SELECT price, COALESCE(sold_at, created_at) FROM market_listings
+            WHERE player_id = market_stats.player_id AND status = 'sold'
+            ORDER BY COALESCE(sold_at, created_at) DESC, id DESC LIMIT 1)
+        WHERE sales > 0
+    """)
+    conn.execute("""
+        INSERT INTO market_stats_hourly(player_id, hour, sales, volume)
+        SELECT player_id, COALESCE(sold_at, created_at) / 3600 * 3600 AS hour, COUNT(*), SUM(price)
+        FROM market_listings WHERE status = 'sold' AND COALESCE(sold_at, created_at) >= ?
+        GROUP BY player_id, hour
+    """, (since,))
 
-    conn.commit()
-
-    # Backward-compatible migration for old schema where users PK was `id`.
-    cur.execute("PRAGMA table_info(users)")
-    users_cols = [r[1] for r in cur.fetchall()]
-    if users_cols and "user_id" not in users_cols and "id" in users_cols:
-        cur.execute("ALTER TABLE users RENAME TO users_old")
-        cur.execute("PRAGMA table_info(users_old)")
-        old_cols = [r[1] for r in cur.fetchall()]
-        pack_col = "COALESCE(pack_credits, 0)" if "pack_credits" in old_cols else "0"
-        cur.execute("""
-        CREATE TABLE users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            club_id INTEGER DEFAULT 0,
-            club_name TEXT DEFAULT '',
-            coins INTEGER NOT NULL DEFAULT 0,
-            last_daily INTEGER NOT NULL DEFAULT 0,
-            pack_credits INTEGER NOT NULL DEFAULT 0,
-            created_at INTEGER DEFAULT (strftime('%s','now'))
-        )
-        """)
-        cur.execute(f"""
-        INSERT INTO users (user_id, username, club_id, club_name, coins, last_daily, pack_credits)
-        SELECT
-            id,
-            '',
-            0,
-            COALESCE(club_custom, ''),
-            COALESCE(coins, 0),
-            COALESCE(last_daily, 0),
-            {pack_col}
-        FROM users_old
-        """)
-        cur.execute("DROP TABLE users_old")
+# =========================
+# Migrations
+# =========================
+# Schema changes are versioned with PRAGMA user_version and applied by
+# `python migrate.py` (gunicorn.conf.py runs it once in the master before
+# forking). Importing this module does no DDL: it only reads the versions and
+# /health answers 503 until the files are current.
+#
+# MIGRATIONS is append-only: (scope, description, fn). "shared" steps run on
+# DB_PATH, "user" steps on every shard file (DB_PATH too when DB_SHARDS=1).
+# Every file walks the whole list and its user_version counts the steps it has
+# gone through, so one number describes a file whatever its role.
+def _exec_all(statements):
+    def run(conn):
+        for sql in statements:
+            conn.execute(sql)
+    return run
+
+def _add_column(table: str, column: str, decl: str):
+    def run(conn):
+        if column not in [r[1] for r in conn.execute(f"PRAGMA table_info({table})")]:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return run
+
+def _migrate_legacy_users(conn):
+    # Old schema where users PK was `id`.
+    users_cols = [r[1] for r in conn.execute("PRAGMA table_info(users)")]
+    if not (users_cols and "user_id" not in users_cols and "id" in users_cols):
+        return
+    conn.execute("ALTER TABLE users RENAME TO users_old")
+    old_cols = [r[1] for r in conn.execute("PRAGMA table_info(users_old)")]
+    pack_col = "COALESCE(pack_credits, 0)" if "pack_credits" in old_cols else "0"
+    conn.execute("""
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        club_id INTEGER DEFAULT 0,
+        club_name TEXT DEFAULT '',
+        coins INTEGER NOT NULL DEFAULT 0,
+        last_daily INTEGER NOT NULL DEFAULT 0,
+        pack_credits INTEGER NOT NULL DEFAULT 0,
+        created_at INTEGER DEFAULT (strftime('%s','now'))
+    )
+    """)
+    conn.execute(f"""
+    INSERT INTO users (user_id, username, club_id, club_name, coins, last_daily, pack_credits)
+    SELECT
+        id,
+        '',
+        0,
+        COALESCE(club_custom, ''),
+        COALESCE(coins, 0),
+        COALESCE(last_daily, 0),
+        {pack_col}
+    FROM users_old
+    """)
+    conn.execute("DROP TABLE users_old")
+
+MIGRATIONS = [
+    # 1-5: what init_db()/ensure_pack_credits_col() used to do on import; idempotent,
+    # so databases created before versioning just get stamped.
+    ("shared", "base tables", _exec_all(SHARED_SCHEMA)),
+    ("user", "base tables", _exec_all([sql for sql in USER_SCHEMA if "user_rev" not in sql])),
+    ("user", "users keyed by user_id (legacy users.id)", _migrate_legacy_users),
+    ("user", "users.pack_credits", _add_column("users", "pack_credits", "INTEGER NOT NULL DEFAULT 0")),
+    ("user", "inventory.rev, user_rev + triggers for /api/sync",
+     lambda conn: (_add_column("inventory", "rev", "INTEGER NOT NULL DEFAULT 0")(conn),
+                   _exec_all([sql for sql in USER_SCHEMA if "user_rev" in sql] + SYNC_SCHEMA)(conn))),
+    ("shared", "market_stats + triggers for /api/market/stats",
+     lambda conn: (_exec_all(MARKET_STATS_SCHEMA)(conn), rebuild_market_stats(conn))),
+    ("shared", "grant_jobs", _exec_all(GRANT_SCHEMA)),
+    ("user", "grant_done", _exec_all(GRANT_USER_SCHEMA)),
+    ("user", "action_leases for per_user_admission", _exec_all(LEASE_SCHEMA)),
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def schema_files():
+    """{path: scopes} of every database file of this deployment."""
+    files = {DB_PATH: {"shared"}}
+    for path in shard_paths():
+        files.setdefault(path, set()).add("user")
+    return files
+
+def schema_version(path: str) -> int:
+    try:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    except sqlite3.OperationalError:
+        return 0  # doesn't exist yet
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
 
-    conn.close()
+def pending_schema():
+    """Files that are behind SCHEMA_VERSION: {path: version}."""
+    versions = {path: schema_version(path) for path in schema_files()}
+    return {path: v for path, v in versions.items() if v < SCHEMA_VERSION}
+
+def migrate(log=print):
+    """Bring every database file to SCHEMA_VERSION, one transaction per step."""
+    global SCHEMA_PENDING
+    for path, scopes in schema_files().items():
+        conn = sqlite3.connect(path, isolation_level=None, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            conn.close()
+            raise RuntimeError(f"{path} is at schema {version}, newer than this code ({SCHEMA_VERSION})")
+        for n, (scope, desc, fn) in enumerate(MIGRATIONS[version:], start=version + 1):
+            t0 = time.perf_counter()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if scope in scopes:
+                    fn(conn)
+                conn.execute(f"PRAGMA user_version={n}")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                conn.close()
+                raise
+            log(f"{path}: {n:>3} {desc:<48} {'applied' if scope in scopes else 'skipped'} "
+                f"{(time.perf_counter() - t0) * 1000:8.1f}ms")
+        conn.close()
+    SCHEMA_PENDING = pending_schema()
 
-init_db()
+SCHEMA_PENDING = pending_schema()
+if SCHEMA_PENDING:
+    print(f"[schema] {len(SCHEMA_PENDING)} database file(s) behind version {SCHEMA_VERSION}, "
+          f"run `python migrate.py`", file=sys.stderr)
 
 # =========================
 # Telegram helpers
 # =========================
-def tg(method: str, payload: dict):
-    if not BOT_TOKEN:
-        return {"ok": False, "description": "BOT_TOKEN missing"}
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/{method}"
-    data = json.dumps(payload).encode("utf-8")
+# asgi.py replaces this with an async client; a transport has call(url, body) -> dict
+# (blocks the calling thread only) and send(url, body) (fire-and-forget).
+TG_TRANSPORT = None
+
+
+def tg_post(url: str, data: bytes) -> dict:
     req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
     try:
         with urllib.request.urlopen(req, timeout=20) as resp:
@@ -209,25 +983,42 @@ def tg(method: str, payload: dict):
     except Exception as e:
         return {"ok": False, "description": str(e)}
 
+def tg(method: str, payload: dict, wait: bool = True):
+    if not BOT_TOKEN:
+        return {"ok": False, "description": "BOT_TOKEN missing"}
+    count("tg_calls")
+    url = f"https://api.telegram.org/bot{BOT_TOKEN}/{method}"
+    data = json.dumps(payload).encode("utf-8")
+    if TG_TRANSPORT is None:
+        return tg_post(url, data)
+    if not wait:
+        TG_TRANSPORT.send(url, data)
+        return {"ok": True, "result": None}
+    return TG_TRANSPORT.call(url, data)
+
 def tg_send_message(chat_id: int, text: str, reply_markup=None):
     payload = {"chat_id": chat_id, "text": text}
     if reply_markup:
         payload["reply_markup"] = reply_markup
-    return tg("sendMessage", payload)
+    # nobody reads the reply, don't hold the request for it
+    return tg("sendMessage", payload, wait=False)
 
 # =========================
 # Economy / Inventory
 # =========================
-def log_tx(user_id: int, kind: str, delta: int, note: str = ""):
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO tx_log(user_id, kind, delta, note) VALUES(?,?,?,?)",
-                (user_id, kind, int(delta), note[:200]))
+def log_tx(user_id: int, kind: str, delta: int, note: str = "", cur=None):
+    """Append to tx_log; pass `cur` to make it part of the caller's transaction."""
+    if cur is not None:
+        cur.execute("INSERT INTO tx_log(user_id, kind, delta, note) VALUES(?,?,?,?)",
+                    (user_id, kind, int(delta), note[:200]))
+        return
+    conn = udb(user_id)
+    log_tx(user_id, kind, delta, note, conn.cursor())
     conn.commit()
     conn.close()
 
 def ensure_user(user_id: int, username: str = ""):
-    conn = db()
+    conn = udb(user_id)
     cur = conn.cursor()
     cur.execute("INSERT OR IGNORE INTO users(user_id, username) VALUES(?,?)", (user_id, username))
     if username:
@@ -236,40 +1027,35 @@ def ensure_user(user_id: int, username: str = ""):
     conn.close()
 
 def get_user(user_id: int):
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
+    with urdb(user_id) as conn:
+        row = conn.execute("SELECT * FROM users WHERE user_id=?", (user_id,)).fetchone()
     return dict(row) if row else None
 
 def add_coins(user_id: int, amount: int, kind: str = "coins_add", note: str = ""):
-    conn = db()
+    # balance and tx_log in one transaction: one write lock and one commit
+    conn = udb(user_id)
     cur = conn.cursor()
     cur.execute("UPDATE users SET coins = coins + ? WHERE user_id=?", (int(amount), user_id))
-    conn.commit()
     cur.execute("SELECT coins FROM users WHERE user_id=?", (user_id,))
     coins = cur.fetchone()["coins"]
+    log_tx(user_id, kind, +int(amount), note, cur)
+    conn.commit()
     conn.close()
-    log_tx(user_id, kind, +int(amount), note)
     return coins
 
 def take_coins(user_id: int, amount: int, kind: str = "coins_spend", note: str = "") -> bool:
-    conn = db()
+    conn = udb(user_id)
     cur = conn.cursor()
-    cur.execute("SELECT coins FROM users WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    if not row or row["coins"] < int(amount):
-        conn.close()
-        return False
-    cur.execute("UPDATE users SET coins = coins - ? WHERE user_id=?", (int(amount), user_id))
+    cur.execute("UPDATE users SET coins = coins - ? WHERE user_id=? AND coins >= ?", (int(amount), user_id, int(amount)))
+    taken = cur.rowcount == 1
+    if taken:
+        log_tx(user_id, kind, -int(amount), note, cur)
     conn.commit()
     conn.close()
-    log_tx(user_id, kind, -int(amount), note)
-    return True
+    return taken
 
 def add_player(user_id: int, player_id: int, qty: int = 1):
-    conn = db()
+    conn = udb(user_id)
     cur = conn.cursor()
     cur.execute("INSERT OR IGNORE INTO inventory(user_id, player_id, qty) VALUES(?,?,0)", (user_id, player_id))
     cur.execute("UPDATE inventory SET qty = qty + ? WHERE user_id=? AND player_id=?", (int(qty), user_id, player_id))
@@ -277,7 +1063,7 @@ def add_player(user_id: int, player_id: int, qty: int = 1):
     conn.close()
 
 def remove_player(user_id: int, player_id: int, qty: int = 1) -> bool:
-    conn = db()
+    conn = udb(user_id)
     cur = conn.cursor()
     cur.execute("SELECT qty FROM inventory WHERE user_id=? AND player_id=?", (user_id, player_id))
     row = cur.fetchone()
@@ -289,20 +1075,53 @@ def remove_player(user_id: int, player_id: int, qty: int = 1) -> bool:
     conn.close()
     return True
 
+def get_inventory_rows(user_id: int):
+    with urdb(user_id) as conn:
+        rows = conn.execute("SELECT player_id, qty FROM inventory WHERE user_id=? AND qty>0", (user_id,)).fetchall()
+    return [(int(r["player_id"]), int(r["qty"])) for r in rows]
+
 def get_inventory(user_id: int):
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT player_id, qty FROM inventory WHERE user_id=? AND qty>0", (user_id,))
-    rows = cur.fetchall()
-    conn.close()
     items = []
-    for r in rows:
-        pid = int(r["player_id"])
+    for pid, qty in get_inventory_rows(user_id):
         p = PLAYERS_BY_ID.get(pid)
         if p:
-            items.append({"player": p, "qty": int(r["qty"])})
+            items.append({"player": p, "qty": qty})
     return items
 
+SYNC_MAX_CHANGES = 200  # more changed cards than this: /api/sync sends a snapshot instead
+
+def encode_inventory(rows) -> bytes:
+    return b"[" + b",".join(
+        b'{"player":' + PLAYER_JSON[pid] + b',"qty":' + str(qty).encode() + b"}"
+        for pid, qty in rows if pid in PLAYER_JSON) + b"]"
+
+def read_profile(conn, user_id: int) -> dict:
+    """The `user` object of /api/bootstrap and /api/sync, defaults for unknown users."""
+    row = conn.execute("SELECT * FROM users WHERE user_id=?", (user_id,)).fetchone()
+    lr = conn.execute("SELECT xp, level FROM user_level WHERE user_id=?", (user_id,)).fetchone()
+    vr = conn.execute("SELECT vip_until FROM vip WHERE user_id=?", (user_id,)).fetchone()
+    u = dict(row) if row else {}
+    level = int(lr["level"]) if lr else 1
+    return {
+        "user_id": user_id,
+        "username": u.get("username",""),
+        "club_id": u.get("club_id", 0),
+        "club_name": u.get("club_name",""),
+        "coins": u.get("coins", 0),
+        "pack_credits": u.get("pack_credits", 0),
+        "last_daily": u.get("last_daily", 0),
+        "vip": bool(vr) and int(vr["vip_until"]) > int(time.time()),
+        "vip_until": int(vr["vip_until"]) if vr else 0,
+        "level": level,
+        "xp": int(lr["xp"]) if lr else 0,
+        "need": xp_needed(level)
+    }
+
+def read_rev(conn, user_id: int):
+    """(rev, profile_rev) of the user, (0, 0) before their first change."""
+    row = conn.execute("SELECT rev, profile_rev FROM user_rev WHERE user_id=?", (user_id,)).fetchone()
+    return (int(row["rev"]), int(row["profile_rev"])) if row else (0, 0)
+
 def squad_rating(user_id: int) -> int:
     inv = get_inventory(user_id)
     ratings = []
@@ -316,38 +1135,260 @@ def squad_rating(user_id: int) -> int:
     return int(sum(top) / len(top))
 
 # =========================
-# VIP + Level
+# Transfers (buyer pays seller for an escrowed card)
 # =========================
-def is_vip(user_id: int) -> bool:
+# A market purchase or accepted P2P trade touches up to three files: the shared
+# DB (listing/trade + journal), the buyer's shard and the seller's shard.
+# SQLite can't commit across files atomically, so it runs as a journaled saga:
+#   1. reserve (shared)  claim the listing/trade (active->pending, pending->accepting)
+#                        and journal the transfer as 'reserved'
+#   2. debit   (buyer)   take price+fee from the buyer        -> transfer 'debited'
+#   3. credit  (seller)  pay the seller the price
+#      deliver (buyer)   put the card into the buyer's inventory
+#   4. finish  (shared)  listing 'sold' / trade 'accepted'    -> transfer 'done'
+# Every shard-local step inserts (transfer_id, step) into transfer_steps in the
+# same transaction as its writes, so replaying a step is a no-op. A failed debit
+# aborts the transfer and releases the listing/trade. recover_transfers() rolls
+# stuck transfers forward if the buyer was debited and aborts them otherwise;
+# every worker runs it (and prune_transfers) every RECOVER_EVERY seconds, see
+# start_recovery(), and `python shards.py recover` does it by hand.
+TRANSFER_KINDS = {
+    # kind: (table, free status, claimed status, final status, final ts column, debit kind, credit kind, note)
+    "market_buy": ("market_listings", "active", "pending", "sold", "sold_at",
+                   "market_buy", "market_sell", "Listing {ref}"),
+    "p2p_player": ("p2p_player_trades", "pending", "accepting", "accepted", "accepted_at",
+                   "p2p_player_pay", "p2p_player_receive_coins", "Trade {ref}"),
+}
+
+def start_transfer(kind: str, ref_id: int, buyer_id: int, seller_id: int, player_id: int, price: int, fee: int = 0):
+    table, free, claimed = TRANSFER_KINDS[kind][:3]
     conn = db()
     cur = conn.cursor()
-    cur.execute("SELECT vip_until FROM vip WHERE user_id=?", (user_id,))
+    cur.execute(f"UPDATE {table} SET status=? WHERE id=? AND status=?", (claimed, ref_id, free))
+    if cur.rowcount == 0:
+        conn.rollback()
+        conn.close()
+        return None
+    cur.execute("""
+        INSERT INTO transfers(kind, ref_id, buyer_id, seller_id, player_id, price, fee, state)
+        VALUES(?,?,?,?,?,?,?,'reserved')
+    """, (kind, ref_id, buyer_id, seller_id, player_id, price, fee))
+    transfer_id = cur.lastrowid
+    conn.commit()
+    conn.close()
+    return transfer_id
+
+def apply_transfer_step(transfer_id: int, step: str, user_id: int, fn) -> bool:
+    conn = udb(user_id)
+    cur = conn.cursor()
+    try:
+        cur.execute("INSERT INTO transfer_steps(transfer_id, step, user_id) VALUES(?,?,?)",
+                    (transfer_id, step, user_id))
+    except sqlite3.IntegrityError:
+        conn.rollback()
+        conn.close()
+        return True  # already applied
+    if not fn(cur):
+        conn.rollback()
+        conn.close()
+        return False
+    conn.commit()
+    conn.close()
+    return True
+
+def transfer_step_applied(transfer_id: int, step: str, user_id: int) -> bool:
+    conn = udb(user_id)
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM transfer_steps WHERE transfer_id=? AND step=?", (transfer_id, step))
     row = cur.fetchone()
     conn.close()
+    return row is not None
+
+def set_transfer_state(transfer_id: int, state: str):
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("UPDATE transfers SET state=?, updated_at=strftime('%s','now') WHERE id=?", (state, transfer_id))
+    conn.commit()
+    conn.close()
+
+def get_transfer(transfer_id: int):
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM transfers WHERE id=?", (transfer_id,))
+    row = cur.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+def abort_transfer(t: dict):
+    table, free, claimed = TRANSFER_KINDS[t["kind"]][:3]
+    conn = db()
+    cur = conn.cursor()
+    # only from 'reserved': several workers may recover the same transfer
+    cur.execute("UPDATE transfers SET state='aborted', updated_at=strftime('%s','now') "
+                "WHERE id=? AND state='reserved'", (t["id"],))
+    if cur.rowcount == 1:
+        cur.execute(f"UPDATE {table} SET status=? WHERE id=? AND status=?", (free, t["ref_id"], claimed))
+    conn.commit()
+    conn.close()
+
+def run_transfer(transfer_id: int) -> bool:
+    """Drive a reserved/debited transfer to 'done'. False if the buyer can't pay (transfer aborted)."""
+    t = get_transfer(transfer_id)
+    if not t or t["state"] in ("done", "aborted"):
+        return bool(t) and t["state"] == "done"
+    table, _, claimed, final, final_ts, debit_kind, credit_kind, note = TRANSFER_KINDS[t["kind"]]
+    note = note.format(ref=t["ref_id"])
+    buyer_id, seller_id = int(t["buyer_id"]), int(t["seller_id"])
+    price, fee = int(t["price"]), int(t["fee"])
+    total = price + fee
+
+    if t["state"] == "reserved":
+        def debit(cur):
+            cur.execute("UPDATE users SET coins = coins - ? WHERE user_id=? AND coins >= ?", (total, buyer_id, total))
+            if cur.rowcount == 0:
+                return False
+            cur.execute("INSERT INTO tx_log(user_id, kind, delta, note) VALUES(?,?,?,?)",
+                        (buyer_id, debit_kind, -total, f"{note}: {price}+fee{fee}" if fee else note))
+            return True
+        if not apply_transfer_step(transfer_id, "debit", buyer_id, debit):
+            abort_transfer(t)
+            return False
+        set_transfer_state(transfer_id, "debited")
+
+    def credit(cur):
+        cur.execute("UPDATE users SET coins = coins + ? WHERE user_id=?", (price, seller_id))
+        cur.execute("INSERT INTO tx_log(user_id, kind, delta, note) VALUES(?,?,?,?)",
+                    (seller_id, credit_kind, price, note))
+        return True
+
+    def deliver(cur):
+        cur.execute("INSERT OR IGNORE INTO inventory(user_id, player_id, qty) VALUES(?,?,0)",
+                    (buyer_id, t["player_id"]))
+        cur.execute("UPDATE inventory SET qty = qty + 1 WHERE user_id=? AND player_id=?", (buyer_id, t["player_id"]))
+        return True
+
+    apply_transfer_step(transfer_id, "credit", seller_id, credit)
+    apply_transfer_step(transfer_id, "deliver", buyer_id, deliver)
+
+    conn = db()
+    cur = conn.cursor()
+    cur.execute(f"UPDATE {table} SET status=?, {final_ts}=strftime('%s','now') WHERE id=? AND status=?",
+                (final, t["ref_id"], claimed))
+    cur.execute("UPDATE transfers SET state='done', updated_at=strftime('%s','now') WHERE id=?", (transfer_id,))
+    conn.commit()
+    conn.close()
+    return True
+
+def recover_transfers(min_age: int = 60) -> dict:
+    """Finish or abort transfers that a crashed worker left half-way. Only touches
+    transfers idle for `min_age` seconds so in-flight ones are left alone."""
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM transfers WHERE state IN ('reserved','debited') AND updated_at <= ?",
+                (int(time.time()) - min_age,))
+    stuck = [dict(r) for r in cur.fetchall()]
+    conn.close()
+
+    done = aborted = 0
+    for t in stuck:
+        if t["state"] == "reserved" and not transfer_step_applied(t["id"], "debit", int(t["buyer_id"])):
+            abort_transfer(t)
+            aborted += 1
+            continue
+        set_transfer_state(t["id"], "debited")
+        run_transfer(t["id"])
+        done += 1
+    return {"finished": done, "aborted": aborted}
+
+def prune_transfers(keep: int = None, batch: int = 5000) -> int:
+    """Delete finished journal rows (and their transfer_steps) older than `keep` seconds."""
+    keep = TRANSFERS_KEEP if keep is None else keep
+    conn = db()
+    # ids are increasing: everything below the oldest open or recent transfer is finished and old
+    row = conn.execute("""
+        SELECT MIN(id) FROM transfers
+        WHERE state IN ('reserved','debited') OR updated_at > ?
+    """, (int(time.time()) - keep,)).fetchone()
+    bound = row[0] if row[0] is not None else (conn.execute("SELECT MAX(id) FROM transfers").fetchone()[0] or 0) + 1
+    lo = conn.execute("SELECT MIN(id) FROM transfers").fetchone()[0] or bound
+    pruned = 0
+    # steps first: a crash in between leaves journal rows to retry, not orphaned steps
+    for path in shard_paths():
+        shard = connect(path)
+        for start in range(lo, bound, batch):
+            shard.execute("DELETE FROM transfer_steps WHERE transfer_id >= ? AND transfer_id < ?",
+                          (start, min(start + batch, bound)))
+            shard.commit()
+        shard.close()
+    for start in range(lo, bound, batch):
+        pruned += conn.execute("DELETE FROM transfers WHERE id >= ? AND id < ?", (start, min(start + batch, bound))).rowcount
+        conn.commit()
+    conn.close()
+    return pruned
+
+RECOVER_EVERY = as_int(os.environ.get("RECOVER_EVERY"), 60)  # seconds, 0 = only `shards.py recover`
+RECOVER_MIN_AGE = 60  # a transfer idle this long belongs to a dead request
+TRANSFERS_KEEP = 86400  # finished transfers kept for inspection
+_recovery = {}  # pid -> thread
+
+def _recovery_loop():
+    time.sleep(random.uniform(1, 5))  # workers start together, don't all scan at once
+    while True:
+        try:
+            res = recover_transfers(min_age=RECOVER_MIN_AGE)
+            if res["finished"] or res["aborted"]:
+                print(f"[transfers] recovered {res}", file=sys.stderr)
+            prune_transfers()
+        except sqlite3.Error as e:
+            print(f"[transfers] recovery failed: {e}", file=sys.stderr)
+        time.sleep(RECOVER_EVERY * random.uniform(0.8, 1.2))
+
+def start_recovery():
+    """Recover stuck transfers in this process now and every RECOVER_EVERY seconds.
+    Called once a worker is up (gunicorn.conf.py, asgi.py, `python server.py`),
+    never on import."""
+    if RECOVER_EVERY <= 0 or os.getpid() in _recovery:
+        return
+    t = _recovery[os.getpid()] = threading.Thread(target=_recovery_loop, name="transfer-recovery", daemon=True)
+    t.start()
+
+# =========================
+# VIP + Level
+# =========================
+def is_vip(user_id: int) -> bool:
+    with urdb(user_id) as conn:
+        row = conn.execute("SELECT vip_until FROM vip WHERE user_id=?", (user_id,)).fetchone()
     if not row:
         return False
     return int(row["vip_until"]) > int(time.time())
 
-def ensure_level_row(user_id: int):
-    conn = db()
+def add_vip_days(user_id: int, days: int, note: str = "") -> int:
+    """Extend VIP by `days` from now or from the current expiry, whichever is later. Returns the new expiry."""
+    now = int(time.time())
+    conn = udb(user_id)
     cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO user_level(user_id, xp, level) VALUES(?,?,?)", (user_id, 0, 1))
+    cur.execute("""
+        INSERT INTO vip(user_id, vip_until) VALUES(?,?)
+        ON CONFLICT(user_id) DO UPDATE SET vip_until = MAX(vip_until, ?) + ?
+    """, (user_id, now + days * 86400, now, days * 86400))
+    cur.execute("SELECT vip_until FROM vip WHERE user_id=?", (user_id,))
+    new_until = int(cur.fetchone()["vip_until"])
+    log_tx(user_id, "vip", 0, f"VIP until {new_until}" + (f" {note}" if note else ""), cur)
     conn.commit()
     conn.close()
+    return new_until
 
 def xp_needed(level: int) -> int:
     return 100 + (level - 1) * 60
 
 def add_xp(user_id: int, amount: int, note: str = ""):
-    ensure_level_row(user_id)
-    conn = db()
+    # one transaction (the INSERT takes the write lock before the read)
+    conn = udb(user_id)
     cur = conn.cursor()
-    cur.execute("UPDATE user_level SET xp = xp + ? WHERE user_id=?", (int(amount), user_id))
-    conn.commit()
-
+    cur.execute("INSERT OR IGNORE INTO user_level(user_id, xp, level) VALUES(?,?,?)", (user_id, 0, 1))
     cur.execute("SELECT xp, level FROM user_level WHERE user_id=?", (user_id,))
     row = cur.fetchone()
-    xp, lvl = int(row["xp"]), int(row["level"])
+    xp, lvl = int(row["xp"]) + int(amount), int(row["level"])
 
     leveled_up = False
     while xp >= xp_needed(lvl):
@@ -356,14 +1397,13 @@ def add_xp(user_id: int, amount: int, note: str = ""):
         leveled_up = True
 
     cur.execute("UPDATE user_level SET xp=?, level=? WHERE user_id=?", (xp, lvl, user_id))
-    conn.commit()
-    conn.close()
-
     if leveled_up:
-        add_coins(user_id, 50, kind="level_up", note=f"Level {lvl}")
-
+        cur.execute("UPDATE users SET coins = coins + 50 WHERE user_id=?", (user_id,))
+        log_tx(user_id, "level_up", 50, f"Level {lvl}", cur)
     if note:
-        log_tx(user_id, "xp", 0, f"+{amount} XP: {note}")
+        log_tx(user_id, "xp", 0, f"+{amount} XP: {note}", cur)
+    conn.commit()
+    conn.close()
 
     return {"xp": xp, "level": lvl, "leveled_up": leveled_up}
 
@@ -377,47 +1417,498 @@ CATALOG = {
     "sub_vip": {"title": "VIP на 30 дней", "desc": "Бонус +10% наград", "stars": 50, "grant": {"vip_days": 30}},
 }
 
-# store packs in user coins? we'll use "packs balance" via log only -> simple: packs are opened instantly after purchase? we grant "open tokens" as coins? We'll store packs as coins-like in tx note? Better: store in users table? We'll use coins only and open packs anytime with coins cost? 
-# For simplicity: purchases grant "pack_credits" stored in users table as coins? We'll add field pack_credits.
-def ensure_pack_credits_col():
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("PRAGMA table_info(users)")
-    cols = [r["name"] for r in cur.fetchall()]
-    if "pack_credits" not in cols:
-        cur.execute("ALTER TABLE users ADD COLUMN pack_credits INTEGER NOT NULL DEFAULT 0")
-        conn.commit()
-    conn.close()
-ensure_pack_credits_col()
-
+# For simplicity: purchases grant "pack_credits" stored in users table (see MIGRATIONS).
 def add_packs(user_id: int, n: int, note=""):
-    conn = db()
+    conn = udb(user_id)
     cur = conn.cursor()
     cur.execute("UPDATE users SET pack_credits = pack_credits + ? WHERE user_id=?", (int(n), user_id))
+    log_tx(user_id, "packs_add", 0, f"+{n} packs {note}", cur)
     conn.commit()
     conn.close()
-    log_tx(user_id, "packs_add", 0, f"+{n} packs {note}")
 
 def take_pack(user_id: int) -> bool:
+    conn = udb(user_id)
+    cur = conn.cursor()
+    # one statement: two concurrent opens can't both spend the last credit
+    cur.execute("UPDATE users SET pack_credits = pack_credits - 1 WHERE user_id=? AND pack_credits > 0", (user_id,))
+    taken = cur.rowcount == 1
+    if taken:
+        log_tx(user_id, "pack_open", 0, "Opened pack", cur)
+    conn.commit()
+    conn.close()
+    return taken
+
+# =========================
+# Bulk grants (live-ops, compensation)
+# =========================
+# bulk_grant() gives a CATALOG-style grant to many users: per shard, in chunks
+# of GRANT_CHUNK users, each chunk one transaction with executemany for the
+# balances and tx_log. The users a job reached go into grant_done in the same
+# transaction, so re-running an interrupted job (same name) skips them and a
+# user is never granted twice. See `python grant.py`.
+GRANT_CHUNK = 2000
+GRANT_KEYS = ("coins", "packs", "vip_days")
+
+def parse_grant(spec) -> dict:
+    """Validated grant dict ({"coins": 500, "vip_days": 3}); ValueError on bad input."""
+    if isinstance(spec, str):
+        spec = CATALOG[spec]["grant"] if spec in CATALOG else json.loads(spec)
+    if not isinstance(spec, dict) or not spec:
+        raise ValueError("grant must be a non-empty object")
+    unknown = set(spec) - set(GRANT_KEYS)
+    if unknown:
+        raise ValueError(f"unknown grant keys: {', '.join(sorted(unknown))}")
+    grant = {k: as_int(v, 0) for k, v in spec.items()}
+    if any(v <= 0 for v in grant.values()):
+        raise ValueError("grant amounts must be positive integers")
+    return grant
+
+def start_grant_job(job: str, grant: dict):
+    """Register `job` (or resume it if the grant is the same); ValueError if the name is taken by another grant."""
+    spec = json.dumps(grant, sort_keys=True)
     conn = db()
     cur = conn.cursor()
-    cur.execute("SELECT pack_credits FROM users WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    if not row or int(row["pack_credits"]) <= 0:
+    cur.execute("INSERT OR IGNORE INTO grant_jobs(job, grant_spec) VALUES(?,?)", (job, spec))
+    cur.execute("SELECT grant_spec FROM grant_jobs WHERE job=?", (job,))
+    existing = cur.fetchone()["grant_spec"]
+    conn.commit()
+    conn.close()
+    if existing != spec:
+        raise ValueError(f"job {job!r} already exists with grant {existing}")
+
+def grant_chunk(conn, job: str, grant: dict, user_ids: list) -> int:
+    """Apply `grant` to the users of one shard not yet reached by `job`, in one transaction."""
+    now = int(time.time())
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute(f"SELECT user_id FROM grant_done WHERE job=? AND user_id IN ({','.join('?' * len(user_ids))})",
+                    (job, *user_ids))
+        done = {r[0] for r in cur.fetchall()}
+        todo = [(uid,) for uid in dict.fromkeys(user_ids) if uid not in done]
+        if not todo:
+            conn.rollback()
+            return 0
+        cur.executemany("INSERT OR IGNORE INTO users(user_id, username) VALUES(?, '')", todo)
+        tx = []
+        if grant.get("coins"):
+            cur.executemany("UPDATE users SET coins = coins + ? WHERE user_id=?", ((grant["coins"], u) for u, in todo))
+            tx.append(("grant", grant["coins"], job))
+        if grant.get("packs"):
+            cur.executemany("UPDATE users SET pack_credits = pack_credits + ? WHERE user_id=?",
+                            ((grant["packs"], u) for u, in todo))
+            tx.append(("packs_add", 0, f"+{grant['packs']} packs {job}"))
+        if grant.get("vip_days"):
+            secs = grant["vip_days"] * 86400
+            cur.executemany("""
+                INSERT INTO vip(user_id, vip_until) VALUES(?,?)
+                ON CONFLICT(user_id) DO UPDATE SET vip_until = MAX(vip_until, ?) + ?
+            """, ((u, now + secs, now, secs) for u, in todo))
+            tx.append(("vip", 0, f"+{grant['vip_days']}d VIP {job}"))
+        cur.executemany("INSERT INTO tx_log(user_id, kind, delta, note) VALUES(?,?,?,?)",
+                        ((u, kind, delta, note[:200]) for u, in todo for kind, delta, note in tx))
+        cur.executemany("INSERT INTO grant_done(job, user_id) VALUES(?,?)", ((job, u) for u, in todo))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return len(todo)
+
+def bulk_grant(job: str, grant: dict, user_ids, chunk: int = GRANT_CHUNK, log=print) -> dict:
+    grant = parse_grant(grant)
+    start_grant_job(job, grant)
+    by_shard = [[] for _ in shard_paths()]
+    for uid in user_ids:
+        if int(uid) > 0:
+            by_shard[shard_index(uid)].append(int(uid))
+    total = sum(len(ids) for ids in by_shard)
+    granted = seen = 0
+    t0 = time.perf_counter()
+    for path, ids in zip(shard_paths(), by_shard):
+        conn = connect(path)
+        try:
+            for i in range(0, len(ids), chunk):
+                part = ids[i:i + chunk]
+                granted += grant_chunk(conn, job, grant, part)
+                seen += len(part)
+                dt = time.perf_counter() - t0
+                log(f"{job}: {seen}/{total} users, {granted} granted, {seen / dt if dt else 0:.0f} users/s")
+        finally:
+            conn.close()
+    conn = db()
+    conn.execute("UPDATE grant_jobs SET finished_at=strftime('%s','now') WHERE job=?", (job,))
+    conn.commit()
+    conn.close()
+    dt = time.perf_counter() - t0
+    return {"job": job, "grant": grant, "users": total, "granted": granted, "skipped": total - granted,
+            "seconds": round(dt, 2), "users_per_s": round(total / dt) if dt else None}
+
+def grant_job_status(job: str):
+    conn = db()
+    row = conn.execute("SELECT * FROM grant_jobs WHERE job=?", (job,)).fetchone()
+    conn.close()
+    if not row:
+        return None
+    reached = 0
+    for path in shard_paths():
+        conn = connect(path)
+        reached += conn.execute("SELECT COUNT(*) FROM grant_done WHERE job=?", (job,)).fetchone()[0]
         conn.close()
-        return False
-    cur.execute("UPDATE users SET pack_credits = pack_credits - 1 WHERE user_id=?", (user_id,))
+    status = dict(row)
+    status["grant"] = json.loads(status.pop("grant_spec"))
+    status["granted"] = reached
+    return status
+
+# =========================
+# Live events (SSE)
+# =========================
+# Market and P2P endpoints publish() events and /api/events streams them, so the
+# Mini App doesn't have to poll the lists. Each event is appended to the shared
+# `events` table: the publishing process hands it to its own subscribers right
+# away, other worker processes tail the table (EVENTS_POLL) and fan out what they
+# find. Row ids are the SSE ids, so a reconnecting EventSource (Last-Event-ID)
+# gets what it missed from the table.
+EVENTS_QUEUE = as_int(os.environ.get("EVENTS_QUEUE"), 256)  # per stream; overflow -> "resync" and close
+EVENTS_HEARTBEAT = as_int(os.environ.get("EVENTS_HEARTBEAT"), 15)  # seconds between keep-alive comments
+EVENTS_MAX_AGE = as_int(os.environ.get("EVENTS_MAX_AGE"), 300)  # streams end after this, the browser reconnects
+EVENTS_POLL = float(os.environ.get("EVENTS_POLL") or 0.5)
+EVENTS_KEEP = 10000  # rows kept in `events` for replay
+EVENTS_REPLAY = 500  # more missed events than this on reconnect: "resync" instead
+EVENTS_RETRY_MS = 3000
+# Can this process hold streams open? Not under gunicorn's sync workers, where
+# each stream takes a whole worker for EVENTS_MAX_AGE: there /api/events answers
+# 204, /api/bootstrap tells the Mini App not to subscribe and publish() is a no-op. asgi.py and `python
+# server.py` turn it on; EVENTS_STREAM=1 for gunicorn -k gthread/gevent.
+EVENTS_STREAM = os.environ.get("EVENTS_STREAM", "") == "1"
+
+RESYNC = object()
+SSE_PING = b": ping\n\n"
+SSE_RESYNC = b"event: resync\ndata: {}\n\n"
+
+
+class Subscriber:
+    """Bounded mailbox of one /api/events stream."""
+
+    def __init__(self, user_id: int, maxsize: int = EVENTS_QUEUE):
+        self.user_id = user_id
+        self.maxsize = maxsize
+        self.events = collections.deque()
+        self.cond = threading.Condition()
+        self.overflowed = False
+
+    def wants(self, ev) -> bool:
+        return ev[3] is None or self.user_id in ev[3]
+
+    def offer(self, ev):
+        with self.cond:
+            if self.overflowed:
+                return
+            if len(self.events) >= self.maxsize:
+                # a client this far behind reloads the lists instead of us buffering for it
+                self.overflowed = True
+                self.events.clear()
+            else:
+                self.events.append(ev)
+            self.cond.notify()
+        self.wake()
+
+    def wake(self):
+        pass  # asgi.py wakes its event loop here
+
+    def take(self):
+        """Next event, RESYNC after an overflow, None if there is nothing yet."""
+        with self.cond:
+            if self.overflowed:
+                return RESYNC
+            return self.events.popleft() if self.events else None
+
+    def get(self, timeout: float):
+        with self.cond:
+            if not self.events and not self.overflowed:
+                self.cond.wait(timeout)
+            return self.take()
+
+
+class Broker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.relay_pid = None
+        self.last_id = 0
+
+    def subscribe(self, sub: Subscriber) -> Subscriber:
+        with self.lock:
+            self.subscribers.add(sub)
+            if self.relay_pid != os.getpid():  # first subscriber in this (possibly forked) process
+                self.relay_pid = os.getpid()
+                self.last_id = latest_event_id()
+                threading.Thread(target=self.relay, name="events-relay", daemon=True).start()
+        return sub
+
+    def unsubscribe(self, sub: Subscriber):
+        with self.lock:
+            self.subscribers.discard(sub)
+
+    def dispatch(self, ev):
+        with self.lock:
+            subs = list(self.subscribers)
+        for sub in subs:
+            if sub.wants(ev):
+                sub.offer(ev)
+
+    def relay(self):
+        me = str(os.getpid())
+        while True:
+            time.sleep(EVENTS_POLL)
+            if not self.subscribers:
+                continue
+            try:
+                rows = read_events(self.last_id, 1000)
+            except sqlite3.Error:
+                continue
+            for ev, origin in rows:
+                self.last_id = ev[0]
+                if origin != me:
+                    self.dispatch(ev)
+
+
+BROKER = Broker()
+
+
+def latest_event_id() -> int:
+    with rdb() as conn:
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+
+
+def read_events(after_id: int, limit: int):
+    """[(event, origin)] with event = (id, name, data bytes, recipients or None)."""
+    with rdb() as conn:
+        rows = conn.execute("SELECT id, name, data, user_ids, origin FROM events WHERE id>? ORDER BY id LIMIT ?",
+                            (after_id, limit)).fetchall()
+    return [((r["id"], r["name"], r["data"].encode("utf-8"),
+              frozenset(int(u) for u in r["user_ids"].split(",")) if r["user_ids"] else None), r["origin"])
+            for r in rows]
+
+
+def publish(name: str, data: dict, user_ids=None):
+    """Send an event to every stream (user_ids=None) or only to those users' streams."""
+    if not EVENTS_STREAM:
+        return  # nobody can be listening, don't write to the shared DB for nothing
+    body = encode_json(data)
+    recipients = frozenset(user_ids) if user_ids else None
+    eid = None
+    conn = db()
+    try:
+        cur = conn.execute("INSERT INTO events(name, data, user_ids, origin) VALUES(?,?,?,?)",
+                           (name, body.decode("utf-8"), ",".join(map(str, sorted(recipients))) if recipients else None,
+                            str(os.getpid())))
+        conn.commit()
+        eid = cur.lastrowid
+        if eid % 1000 == 0:
+            conn.execute("DELETE FROM events WHERE id<=?", (eid - EVENTS_KEEP,))
+            conn.commit()
+    except sqlite3.Error:
+        pass  # the action itself is done; other workers just miss this event
+    finally:
+        conn.close()
+    BROKER.dispatch((eid, name, body, recipients))
+
+
+def sse_event(ev) -> bytes:
+    head = f"id: {ev[0]}\n" if ev[0] else ""
+    return f"{head}event: {ev[1]}\n".encode("utf-8") + b"data: " + ev[2] + b"\n\n"
+
+
+def sse_prelude(user_id: int, last_id: int):
+    """(bytes to send first, ids already sent): retry hint plus what was missed since last_id."""
+    out = [f"retry: {EVENTS_RETRY_MS}\n\n".encode()]
+    seen = set()
+    if last_id > 0:
+        rows = read_events(last_id, EVENTS_REPLAY + 1)
+        if len(rows) > EVENTS_REPLAY or (rows and rows[0][0][0] > last_id + 1):
+            out.append(SSE_RESYNC)  # too much missed or already pruned
+        else:
+            for ev, _ in rows:
+                seen.add(ev[0])
+                if ev[3] is None or user_id in ev[3]:
+                    out.append(sse_event(ev))
+    return b"".join(out), seen
+
+
+def with_player(row: dict) -> dict:
+    return {**row, "player": PLAYERS_BY_ID.get(int(row["player_id"]))}
+
+# =========================
+# Admission control (per user, per process)
+# =========================
+# Double taps on hot write endpoints otherwise queue up for the shard's write
+# lock one after another. @per_user_admission("name") on a view keyed by the
+# JSON user_id:
+#   - single-flight: a request arriving while the same (user, name) is still
+#     running waits for it and gets a copy of its response ("coalesced");
+#   - token bucket: ADMIT_BURST requests at once, refilled at ADMIT_RATE/s; past
+#     that the request gets 429 + Retry-After without touching the DB.
+# Both are in-process; asgi.py does them on its event loop instead (a duplicate
+# never waits for a pool thread) and marks the request "asgi.admitted". Across
+# workers the endpoints stay correct on their own (conditional UPDATEs in
+# take_pack and api_daily_claim). ADMIT_LEASE=1 additionally makes the leader
+# hold a row in action_leases while the view runs, so a duplicate in another
+# worker gets 429 busy - at the price of two more commits per request.
+ADMIT_RATE = float(os.environ.get("ADMIT_RATE") or 2)  # tokens/s per user and endpoint; 0 = no limit
+ADMIT_BURST = max(1, as_int(os.environ.get("ADMIT_BURST"), 10))  # the Mini App opens up to 5 packs in a row
+ADMIT_WAIT = 10  # seconds a duplicate waits for the running request
+ADMIT_KEYS = 100_000  # buckets kept, least recently used dropped first
+ADMIT_LEASE = os.environ.get("ADMIT_LEASE", "") == "1"
+
+_admit_lock = threading.Lock()
+_admit_buckets = collections.OrderedDict()  # (user_id, name) -> [tokens, monotonic ts]
+_admit_flights = {}  # (user_id, name) -> Flight
+_admit_counts = {}  # (name, outcome) -> n, outcome: rejected / coalesced / busy
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None  # (body, status, headers) of the leader's response
+
+
+def _admit_count(name: str, outcome: str):
+    with _metrics_lock:
+        _admit_counts[(name, outcome)] = _admit_counts.get((name, outcome), 0) + 1
+
+
+def _take_token(key) -> float:
+    """0 if admitted, else seconds until the next token."""
+    if ADMIT_RATE <= 0:
+        return 0.0
+    now = time.monotonic()
+    bucket = _admit_buckets.get(key)
+    if bucket is None:
+        bucket = _admit_buckets[key] = [float(ADMIT_BURST), now]
+        if len(_admit_buckets) > ADMIT_KEYS:
+            _admit_buckets.popitem(last=False)
+    else:
+        _admit_buckets.move_to_end(key)
+        bucket[0] = min(ADMIT_BURST, bucket[0] + (now - bucket[1]) * ADMIT_RATE)
+        bucket[1] = now
+    if bucket[0] >= 1:
+        bucket[0] -= 1
+        return 0.0
+    return (1 - bucket[0]) / ADMIT_RATE
+
+
+def take_lease(user_id: int, name: str) -> float:
+    """Expiry of the lease taken on (user_id, name), 0 while another request holds it."""
+    now = time.time()
+    expires = now + ADMIT_WAIT
+    conn = udb(user_id)
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO action_leases(user_id, name, expires) VALUES(?,?,?)
+        ON CONFLICT(user_id, name) DO UPDATE SET expires=excluded.expires WHERE action_leases.expires <= ?
+    """, (user_id, name, expires, now))
+    taken = cur.rowcount == 1
     conn.commit()
     conn.close()
-    log_tx(user_id, "pack_open", 0, "Opened pack")
-    return True
+    return expires if taken else 0.0
+
+def drop_lease(user_id: int, name: str, expires: float):
+    # only our own: past ADMIT_WAIT the row may already belong to a newer request
+    conn = udb(user_id)
+    try:
+        conn.execute("DELETE FROM action_leases WHERE user_id=? AND name=? AND expires=?", (user_id, name, expires))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _busy():
+    resp = jsonify({"ok": False, "error": "busy"})
+    resp.headers["Retry-After"] = "1"
+    return resp, 429
+
+
+def _leased(user_id, name, view, args, kwargs):
+    if not ADMIT_LEASE:
+        return view(*args, **kwargs)
+    expires = take_lease(user_id, name)
+    if not expires:
+        _admit_count(name, "busy")
+        return _busy()
+    try:
+        return view(*args, **kwargs)
+    finally:
+        try:
+            drop_lease(user_id, name, expires)
+        except sqlite3.Error:
+            pass  # the view's response stands; the lease runs out after ADMIT_WAIT
+
+
+def _replay(result):
+    body, status, headers = result
+    resp = Response(body, status=status, headers=headers)
+    resp.headers["X-Coalesced"] = "1"
+    return resp
+
+
+def per_user_admission(name: str):
+    def wrap(view):
+        @functools.wraps(view)
+        def admitted(*args, **kwargs):
+            user_id = as_int((request.get_json(silent=True) or {}).get("user_id"), 0)
+            if not user_id:
+                return view(*args, **kwargs)
+            if request.environ.get("asgi.admitted"):
+                return _leased(user_id, name, view, args, kwargs)
+            key = (user_id, name)
+            leader, wait = False, 0.0
+            with _admit_lock:
+                flight = _admit_flights.get(key)
+                if flight is None:
+                    wait = _take_token(key)
+                    if not wait:
+                        flight = _admit_flights[key] = Flight()
+                        leader = True
+            if flight is None:
+                _admit_count(name, "rejected")
+                resp = jsonify({"ok": False, "error": "rate_limited", "retry_after": round(wait, 1)})
+                resp.headers["Retry-After"] = str(max(1, int(wait + 0.999)))
+                return resp, 429
+            if not leader:
+                _admit_count(name, "coalesced")
+                if not flight.done.wait(ADMIT_WAIT) or flight.result is None:
+                    return _busy()
+                return _replay(flight.result)
+            try:
+                resp = app.make_response(_leased(user_id, name, view, args, kwargs))
+                flight.result = (resp.get_data(), resp.status_code, [h for h in resp.headers if h[0] != "Content-Length"])
+                return resp
+            finally:
+                with _admit_lock:
+                    _admit_flights.pop(key, None)
+                flight.done.set()
+        admitted.admission = name  # asgi.py finds the routes by this
+        return admitted
+    return wrap
 
 # =========================
 # Routes
 # =========================
 @app.get("/health")
 def health():
-    return jsonify({"ok": True})
+    global SCHEMA_PENDING
+    if SCHEMA_PENDING:
+        SCHEMA_PENDING = pending_schema()  # migrate.py may have run since we started
+        if SCHEMA_PENDING:
+            return jsonify({"ok": False, "error": "schema_outdated", "need": SCHEMA_VERSION,
+                            "files": SCHEMA_PENDING}), 503
+    return jsonify({"ok": True, "schema": SCHEMA_VERSION, "boot_ms": round(BOOT_SECONDS * 1000, 1)})
+
+@app.get("/metrics")
+def metrics():
+    if not METRICS_ENABLED:
+        return jsonify({"ok": False, "error": "metrics_disabled"}), 404
+    return app.response_class(render_metrics(), mimetype="text/plain; version=0.0.4")
 
 @app.get("/")
 def root():
@@ -427,12 +1918,29 @@ def root():
 
 @app.get("/game")
 def game():
-    return send_from_directory("web", "index.html")
+    return web_index()
 
 @app.get("/web/index.html")
 def web_index():
+    if "index.html" in ASSET_MANIFEST.get("files", {}):
+        # entry point keeps its URL: always revalidated (ETag), everything it links is immutable
+        return send_asset("index.html", "no-cache")
     return send_from_directory("web", "index.html")
 
+@app.get("/web/assets/<path:name>")
+def web_asset(name):
+    return send_asset(name, IMMUTABLE)
+
+@app.get("/web/images/<any(players, clubs):kind>/<path:name>")
+def web_image(kind, name):
+    # unversioned URL (script.js builds it from players.json): cache for a day only
+    rel = ASSET_MANIFEST.get("files", {}).get(f"images/{kind}/{name}")
+    if rel:
+        return send_asset(rel, "public, max-age=86400")
+    resp = send_from_directory(os.path.join("static", kind), name)
+    resp.headers["Cache-Control"] = "public, max-age=86400"
+    return resp
+
 @app.post("/webhook")
 def webhook():
     upd = request.get_json(silent=True) or {}
@@ -473,21 +1981,8 @@ def webhook():
                 add_packs(user_id, as_int(grant["packs"], 0), note=product)
                 lines.append(f"✅ Паков добавлено: {grant['packs']}")
             if "vip_days" in grant:
-                days = as_int(grant["vip_days"], 0)
-                add_seconds = days * 86400
-                now = int(time.time())
-                conn2 = db()
-                cur2 = conn2.cursor()
-                cur2.execute("INSERT OR IGNORE INTO vip(user_id, vip_until) VALUES(?,0)", (user_id,))
-                conn2.commit()
-                cur2.execute("SELECT vip_until FROM vip WHERE user_id=?", (user_id,))
-                cur_until = as_int(cur2.fetchone()["vip_until"], 0)
-                new_until = max(cur_until, now) + add_seconds
-                cur2.execute("UPDATE vip SET vip_until=? WHERE user_id=?", (new_until, user_id))
-                conn2.commit()
-                conn2.close()
+                new_until = add_vip_days(user_id, as_int(grant["vip_days"], 0))
                 lines.append(f"⭐ VIP активен до: {time.strftime('%Y-%m-%d', time.gmtime(new_until))}")
-                log_tx(user_id, "vip", 0, f"VIP until {new_until}")
 
         tg_send_message(upd["message"]["chat"]["id"], "\n".join(lines) if lines else "Оплата получена ✅")
         return jsonify({"ok": True})
@@ -526,54 +2021,64 @@ def webhook():
 @app.get("/api/bootstrap")
 def api_bootstrap():
     user_id = request.args.get("user_id", type=int)
-    username = request.args.get("username", default="", type=str)
     if not user_id:
         return jsonify({"ok": False, "error": "user_id required"}), 400
 
-    ensure_user(user_id, username)
-    ensure_level_row(user_id)
+    # Read-only: the user row is created by the first write (or /start in the bot),
+    # until then the defaults of read_profile() are returned.
+    with urdb(user_id) as conn:
+        # one snapshot, so `rev` covers exactly what is returned and /api/sync
+        # can't miss a write committed between the reads
+        conn.execute("BEGIN")
+        rev = read_rev(conn, user_id)[0]
+        user = read_profile(conn, user_id)
+        inv = [(int(r["player_id"]), int(r["qty"])) for r in
+               conn.execute("SELECT player_id, qty FROM inventory WHERE user_id=? AND qty>0", (user_id,))]
+
+    return raw_json_response(join_json_object({
+        "ok": True,
+        "user": user,
+        "rev": rev,
+        "events": EVENTS_STREAM,
+        "players_count": len(PLAYERS)
+    }, inventory=encode_inventory(inv), clubs=CLUBS_JSON))
 
-    u = get_user(user_id)
-    inv = get_inventory(user_id)
-    vip = is_vip(user_id)
+@app.get("/api/sync")
+def api_sync():
+    """Changes since the client's `rev` (from /api/bootstrap or the previous sync).
 
-    # level
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT xp, level FROM user_level WHERE user_id=?", (user_id,))
-    lr = cur.fetchone()
-    cur.execute("SELECT vip_until FROM vip WHERE user_id=?", (user_id,))
-    vr = cur.fetchone()
-    conn.close()
+    Inventory entries with qty 0 were removed. `user` is only present if a profile
+    field changed. Unknown/too old revs get a full snapshot ("full": true).
+    """
+    user_id = as_int(request.args.get("user_id"), 0)
+    since = as_int(request.args.get("since"), 0)
+    if not user_id:
+        return jsonify({"ok": False, "error": "user_id required"}), 400
 
-    return jsonify({
-        "ok": True,
-        "user": {
-            "user_id": user_id,
-            "username": u.get("username",""),
-            "club_id": u.get("club_id", 0),
-            "club_name": u.get("club_name",""),
-            "coins": u.get("coins", 0),
-            "pack_credits": u.get("pack_credits", 0),
-            "last_daily": u.get("last_daily", 0),
-            "vip": vip,
-            "vip_until": int(vr["vip_until"]) if vr else 0,
-            "level": int(lr["level"]) if lr else 1,
-            "xp": int(lr["xp"]) if lr else 0,
-            "need": xp_needed(int(lr["level"]) if lr else 1)
-        },
-        "inventory": inv,
-        "clubs": CLUBS,
-        "players_count": len(PLAYERS)
-    })
+    with urdb(user_id) as conn:
+        conn.execute("BEGIN")  # same snapshot for rev and rows, see api_bootstrap
+        rev, profile_rev = read_rev(conn, user_id)
+        full = since <= 0 or since > rev
+        if not full:
+            inv = [(int(r["player_id"]), int(r["qty"])) for r in conn.execute(
+                "SELECT player_id, qty FROM inventory WHERE user_id=? AND rev>? LIMIT ?",
+                (user_id, since, SYNC_MAX_CHANGES + 1))]
+            full = len(inv) > SYNC_MAX_CHANGES
+        if full:
+            inv = [(int(r["player_id"]), int(r["qty"])) for r in
+                   conn.execute("SELECT player_id, qty FROM inventory WHERE user_id=? AND qty>0", (user_id,))]
+        head = {"ok": True, "rev": rev, "full": full}
+        if full or profile_rev > since:
+            head["user"] = read_profile(conn, user_id)
+    return raw_json_response(join_json_object(head, inventory=encode_inventory(inv)))
 
 @app.get("/api/players")
 def api_players():
-    return jsonify({"ok": True, "players": PLAYERS})
+    return raw_json_response(join_json_object({"ok": True}, players=PLAYERS_JSON))
 
 @app.get("/api/clubs")
 def api_clubs():
-    return jsonify({"ok": True, "clubs": CLUBS})
+    return raw_json_response(join_json_object({"ok": True}, clubs=CLUBS_JSON))
 
 @app.post("/api/set_club")
 def api_set_club():
@@ -588,7 +2093,7 @@ def api_set_club():
         return jsonify({"ok": False, "error": "unknown_club"}), 400
 
     ensure_user(user_id)
-    conn = db()
+    conn = udb(user_id)
     cur = conn.cursor()
     cur.execute("UPDATE users SET club_id=?, club_name=? WHERE user_id=?", (club_id, club_name, user_id))
     conn.commit()
@@ -600,6 +2105,7 @@ def api_set_club():
 # Daily reward
 # =========================
 @app.post("/api/daily/claim")
+@per_user_admission("daily_claim")
 def api_daily_claim():
     data = request.get_json(silent=True) or {}
     user_id = as_int(data.get("user_id"), 0)
@@ -607,16 +2113,18 @@ def api_daily_claim():
         return jsonify({"ok": False, "error": "user_id required"}), 400
 
     ensure_user(user_id)
-    u = get_user(user_id)
     now = int(time.time())
-    last = int(u.get("last_daily", 0))
-    if now - last < 24 * 3600:
-        left = 24 * 3600 - (now - last)
-        return jsonify({"ok": False, "error": "cooldown", "left": left}), 400
 
-    conn = db()
+    # conditional: only one of two concurrent claims (other worker, other device) wins
+    conn = udb(user_id)
     cur = conn.cursor()
-    cur.execute("UPDATE users SET last_daily=? WHERE user_id=?", (now, user_id))
+    cur.execute("UPDATE users SET last_daily=? WHERE user_id=? AND last_daily <= ?", (now, user_id, now - 24 * 3600))
+    if cur.rowcount == 0:
+        cur.execute("SELECT last_daily FROM users WHERE user_id=?", (user_id,))
+        last = int(cur.fetchone()["last_daily"])
+        conn.rollback()
+        conn.close()
+        return jsonify({"ok": False, "error": "cooldown", "left": max(1, 24 * 3600 - (now - last))}), 400
     conn.commit()
     conn.close()
 
@@ -630,8 +2138,6 @@ def api_daily_claim():
 # =========================
 # Packs
 # =========================
-import random
-
 def random_player():
     if not PLAYERS:
         return None
@@ -651,6 +2157,7 @@ def random_player():
     return pool[-1][0]
 
 @app.post("/api/open_pack")
+@per_user_admission("open_pack")
 def api_open_pack():
     data = request.get_json(silent=True) or {}
     user_id = as_int(data.get("user_id"), 0)
@@ -675,23 +2182,42 @@ def api_open_pack():
 # =========================
 @app.get("/api/market/list")
 def api_market_list():
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT id, seller_id, player_id, price, status, created_at
-        FROM market_listings
-        WHERE status='active'
-        ORDER BY id DESC
-        LIMIT 50
-    """)
-    rows = cur.fetchall()
-    conn.close()
-
+    with rdb() as conn:
+        rows = conn.execute("""
+            SELECT id, seller_id, player_id, price, status, created_at
+            FROM market_listings
+            WHERE status='active'
+            ORDER BY id DESC
+            LIMIT 50
+        """).fetchall()
+    return raw_json_response(join_json_object({"ok": True}, items=encode_rows_with_player(rows)))
+
+@app.get("/api/market/stats")
+def api_market_stats():
+    """Price reference per player: ?player_id=7, ?player_ids=7,9 or nothing for every traded player."""
+    ids = [as_int(x) for x in (request.args.get("player_ids") or request.args.get("player_id") or "").split(",") if x.strip()]
+    ids = [i for i in ids if i > 0][:100]
+    hour = int(time.time()) // 3600 * 3600
+    day, week = hour - 23 * 3600, hour - MARKET_STATS_KEEP
+    where = f"WHERE s.player_id IN ({','.join('?' * len(ids))})" if ids else ""
+    with rdb() as conn:
+        rows = conn.execute(f"""
+            SELECT s.player_id, s.active, s.min_ask, s.last_price, s.last_sold_at,
+                   COALESCE(SUM(CASE WHEN h.hour >= ? THEN h.sales END), 0) AS sales_24h,
+                   COALESCE(SUM(CASE WHEN h.hour >= ? THEN h.volume END), 0) AS volume_24h,
+                   COALESCE(SUM(h.sales), 0) AS sales_7d,
+                   COALESCE(SUM(h.volume), 0) AS volume_7d
+            FROM market_stats s
+            LEFT JOIN market_stats_hourly h ON h.player_id = s.player_id AND h.hour > ?
+            {where}
+            GROUP BY s.player_id
+        """, (day, day, week, *ids)).fetchall()
     items = []
     for r in rows:
-        p = PLAYERS_BY_ID.get(int(r["player_id"]))
-        if p:
-            items.append({**dict(r), "player": p})
+        item = dict(r)
+        item["avg_24h"] = round(item["volume_24h"] / item["sales_24h"]) if item["sales_24h"] else None
+        item["avg_7d"] = round(item["volume_7d"] / item["sales_7d"]) if item["sales_7d"] else None
+        items.append(item)
     return jsonify({"ok": True, "items": items})
 
 @app.post("/api/market/sell")
@@ -722,8 +2248,42 @@ def api_market_sell():
     conn.close()
 
     add_xp(user_id, 5, "Listed on market")
+    publish("listing_created", with_player({"id": lid, "seller_id": user_id, "player_id": player_id, "price": price,
+                                            "status": "active", "created_at": int(time.time())}))
     return jsonify({"ok": True, "listing_id": lid})
 
+@app.post("/api/market/cancel")
+def api_market_cancel():
+    data = request.get_json(silent=True) or {}
+    user_id = as_int(data.get("user_id"), 0)  # seller
+    listing_id = as_int(data.get("listing_id"), 0)
+    if not user_id or not listing_id:
+        return jsonify({"ok": False, "error": "bad_params"}), 400
+
+    conn = db()
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM market_listings WHERE id=?", (listing_id,))
+    r = cur.fetchone()
+    if not r:
+        conn.close()
+        return jsonify({"ok": False, "error": "not_found"}), 404
+    if int(r["seller_id"]) != user_id:
+        conn.close()
+        return jsonify({"ok": False, "error": "not_seller"}), 403
+
+    # conditional: a buyer may have claimed the listing since the read above
+    cur.execute("UPDATE market_listings SET status='canceled' WHERE id=? AND status='active'", (listing_id,))
+    if cur.rowcount == 0:
+        conn.rollback()
+        conn.close()
+        return jsonify({"ok": False, "error": "not_active"}), 400
+    conn.commit()
+    conn.close()
+
+    add_player(user_id, int(r["player_id"]), 1)
+    publish("listing_canceled", {"id": listing_id})
+    return jsonify({"ok": True})
+
 @app.post("/api/market/buy")
 def api_market_buy():
     data = request.get_json(silent=True) or {}
@@ -753,30 +2313,21 @@ def api_market_buy():
     player_id = int(r["player_id"])
     conn.close()
 
-    if not take_coins(buyer_id, price, kind="market_buy", note=f"Listing {listing_id}"):
-        return jsonify({"ok": False, "error": "not_enough_coins"}), 400
-
-    add_coins(seller_id, price, kind="market_sell", note=f"Listing {listing_id}")
-    add_player(buyer_id, player_id, 1)
-
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("UPDATE market_listings SET status='sold', sold_at=strftime('%s','now') WHERE id=? AND status='active'", (listing_id,))
-    if cur.rowcount == 0:
-        conn.rollback()
-        conn.close()
-        add_coins(buyer_id, price, kind="market_refund", note=f"Listing {listing_id} race condition")
+    transfer_id = start_transfer("market_buy", listing_id, buyer_id, seller_id, player_id, price)
+    if not transfer_id:
         return jsonify({"ok": False, "error": "not_active"}), 400
-    conn.commit()
-    conn.close()
+    if not run_transfer(transfer_id):
+        return jsonify({"ok": False, "error": "not_enough_coins"}), 400
 
     add_xp(buyer_id, 8, "Bought on market")
+    publish("listing_sold", {"id": listing_id, "player_id": player_id, "price": price})
     return jsonify({"ok": True})
 
 # =========================
 # Match (simple)
 # =========================
 @app.post("/api/match/play")
+@per_user_admission("match_play")
 def api_match_play():
     data = request.get_json(silent=True) or {}
     user_id = as_int(data.get("user_id"), 0)
@@ -870,6 +2421,9 @@ def api_p2p_player_create():
     conn.close()
 
     log_tx(seller_id, "p2p_player_lock", 0, f"Trade {trade_id}: locked player {player_id}")
+    publish("trade_created", with_player({"id": trade_id, "seller_id": seller_id, "buyer_id": buyer_id,
+                                          "player_id": player_id, "price": price, "fee": fee, "status": "pending",
+                                          "created_at": int(time.time())}), (seller_id, buyer_id))
     return jsonify({"ok": True, "trade_id": trade_id, "fee": fee})
 
 @app.post("/api/p2p_player/accept")
@@ -901,20 +2455,15 @@ def api_p2p_player_accept():
     fee = int(t["fee"])
     total = price + fee
 
-    if not take_coins(buyer_id, total, kind="p2p_player_pay", note=f"Trade {trade_id}: {price}+fee{fee}"):
+    transfer_id = start_transfer("p2p_player", trade_id, buyer_id, seller_id, player_id, price, fee)
+    if not transfer_id:
+        return jsonify({"ok": False, "error": "not_pending"}), 400
+    if not run_transfer(transfer_id):
         return jsonify({"ok": False, "error": "not_enough_coins", "need": total}), 400
 
-    add_coins(seller_id, price, kind="p2p_player_receive_coins", note=f"Trade {trade_id}")
-    add_player(buyer_id, player_id, 1)
-
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("UPDATE p2p_player_trades SET status='accepted', accepted_at=strftime('%s','now') WHERE id=?", (trade_id,))
-    conn.commit()
-    conn.close()
-
     add_xp(buyer_id, 10, "P2P trade buy")
     add_xp(seller_id, 6, "P2P trade sell")
+    publish("trade_accepted", {"id": trade_id, "status": "accepted"}, (seller_id, buyer_id))
     return jsonify({"ok": True})
 
 @app.post("/api/p2p_player/cancel")
@@ -941,14 +2490,22 @@ def api_p2p_player_cancel():
         return jsonify({"ok": False, "error": "not_seller"}), 403
 
     seller_id = int(t["seller_id"])
+    buyer_id = int(t["buyer_id"])
     player_id = int(t["player_id"])
 
-    add_player(seller_id, player_id, 1)
-    cur.execute("UPDATE p2p_player_trades SET status='canceled' WHERE id=?", (trade_id,))
+    # conditional: an accept may have claimed the trade since the read above
+    cur.execute("UPDATE p2p_player_trades SET status='canceled' WHERE id=? AND status='pending'", (trade_id,))
+    if cur.rowcount == 0:
+        conn.rollback()
+        conn.close()
+        return jsonify({"ok": False, "error": "not_pending"}), 400
     conn.commit()
     conn.close()
 
+    add_player(seller_id, player_id, 1)
+
     log_tx(seller_id, "p2p_player_refund", 0, f"Trade {trade_id}: refunded player {player_id}")
+    publish("trade_canceled", {"id": trade_id, "status": "canceled"}, (seller_id, buyer_id))
     return jsonify({"ok": True})
 
 @app.get("/api/p2p_player/list")
@@ -957,23 +2514,50 @@ def api_p2p_player_list():
     if not user_id:
         return jsonify({"ok": False, "error": "user_id required"}), 400
 
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("""
-      SELECT id, seller_id, buyer_id, player_id, price, fee, status, created_at, accepted_at
-      FROM p2p_player_trades
-      WHERE seller_id=? OR buyer_id=?
-      ORDER BY id DESC
-      LIMIT 50
-    """, (user_id, user_id))
-    rows = cur.fetchall()
-    conn.close()
-
-    items = []
-    for r in rows:
-        p = PLAYERS_BY_ID.get(int(r["player_id"]))
-        items.append({**dict(r), "player": p})
-    return jsonify({"ok": True, "items": items})
+    with rdb() as conn:
+        rows = conn.execute("""
+          SELECT id, seller_id, buyer_id, player_id, price, fee, status, created_at, accepted_at
+          FROM p2p_player_trades
+          WHERE seller_id=? OR buyer_id=?
+          ORDER BY id DESC
+          LIMIT 50
+        """, (user_id, user_id)).fetchall()
+    return raw_json_response(join_json_object({"ok": True},
+                                              items=encode_rows_with_player(rows, skip_unknown=False)))
+
+@app.get("/api/events")
+def api_events():
+    """SSE: listing_created/sold/canceled for everyone, trade_* for the two parties.
+
+    204 unless EVENTS_STREAM: an EventSource stops reconnecting on it.
+    """
+    if not EVENTS_STREAM:
+        return "", 204
+    user_id = as_int(request.args.get("user_id"), 0)
+    if not user_id:
+        return jsonify({"ok": False, "error": "user_id required"}), 400
+    last_id = as_int(request.headers.get("Last-Event-ID") or request.args.get("last_id"), 0)
+    sub = BROKER.subscribe(Subscriber(user_id))
+
+    def stream():
+        try:
+            prelude, seen = sse_prelude(user_id, last_id)
+            yield prelude
+            deadline = time.monotonic() + EVENTS_MAX_AGE
+            while time.monotonic() < deadline:
+                ev = sub.get(EVENTS_HEARTBEAT)
+                if ev is RESYNC:
+                    yield SSE_RESYNC
+                    return
+                if ev is None:
+                    yield SSE_PING
+                elif ev[0] not in seen:
+                    yield sse_event(ev)
+        finally:
+            BROKER.unsubscribe(sub)
+
+    return app.response_class(stream(), mimetype="text/event-stream",
+                              headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # =========================
 # TX / Level / VIP endpoints
@@ -985,12 +2569,9 @@ def api_tx():
     if not user_id:
         return jsonify({"ok": False, "error": "user_id required"}), 400
     limit = max(10, min(limit, 200))
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT kind, delta, note, created_at FROM tx_log WHERE user_id=? ORDER BY id DESC LIMIT ?",
-                (user_id, limit))
-    rows = cur.fetchall()
-    conn.close()
+    with urdb(user_id) as conn:
+        rows = conn.execute("SELECT kind, delta, note, created_at FROM tx_log WHERE user_id=? ORDER BY id DESC LIMIT ?",
+                            (user_id, limit)).fetchall()
     return jsonify({"ok": True, "items": [dict(r) for r in rows]})
 
 @app.get("/api/level")
@@ -998,30 +2579,28 @@ def api_level():
     user_id = request.args.get("user_id", type=int)
     if not user_id:
         return jsonify({"ok": False, "error": "user_id required"}), 400
-    ensure_level_row(user_id)
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT xp, level FROM user_level WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    lvl = int(row["level"])
-    return jsonify({"ok": True, "level": lvl, "xp": int(row["xp"]), "need": xp_needed(lvl)})
+    with urdb(user_id) as conn:
+        row = conn.execute("SELECT xp, level FROM user_level WHERE user_id=?", (user_id,)).fetchone()
+    lvl = int(row["level"]) if row else 1
+    return jsonify({"ok": True, "level": lvl, "xp": int(row["xp"]) if row else 0, "need": xp_needed(lvl)})
 
 @app.get("/api/vip")
 def api_vip():
     user_id = request.args.get("user_id", type=int)
     if not user_id:
         return jsonify({"ok": False, "error": "user_id required"}), 400
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT vip_until FROM vip WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
+    with urdb(user_id) as conn:
+        row = conn.execute("SELECT vip_until FROM vip WHERE user_id=?", (user_id,)).fetchone()
     return jsonify({"ok": True, "vip": (int(row["vip_until"]) > int(time.time())) if row else False,
                     "vip_until": int(row["vip_until"]) if row else 0})
 
 # Run locally:
 # flask --app server run --debug
 
+BOOT_SECONDS = time.perf_counter() - BOOT_STARTED  # import cost of a worker, see /health and /metrics
+
 if __name__ == "__main__":
+    migrate()
+    EVENTS_STREAM = True  # the dev server runs a thread per request
+    start_recovery()
     app.run(host="0.0.0.0", port=as_int(os.environ.get("PORT"), 5000), debug=False)
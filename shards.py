@@ -0,0 +1,194 @@
+"""Shard maintenance for the per-user tables (see DB_SHARDS in server.py).
+
+    python shards.py status                # rows per shard, open transfers
+    python shards.py recover               # finish/abort stuck transfers now (workers do it every RECOVER_EVERY)
+    DB_SHARDS=4 python shards.py reshard --to 8
+
+`reshard` is an offline operation: stop the app first, run it with the current
+DB_SHARDS, then restart the app with DB_SHARDS set to the new count.
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import server  # noqa: E402
+
+BATCH = 50_000
+
+
+def table_ddl(path):
+    """CREATE statements (tables, indexes, then triggers) of the per-user tables in `path`."""
+    conn = sqlite3.connect(path)
+    rows = conn.execute(
+        "SELECT type, name, tbl_name, sql FROM sqlite_master WHERE sql IS NOT NULL AND tbl_name IN (%s) "
+        "ORDER BY CASE type WHEN 'table' THEN 0 WHEN 'index' THEN 1 ELSE 2 END" % ",".join("?" * len(server.USER_TABLES)),
+        server.USER_TABLES).fetchall()
+    conn.close()
+    return rows
+
+
+def table_columns(conn, table):
+    return [r[1] for r in conn.execute(f"PRAGMA table_info({table})")]
+
+
+def status():
+    for i, path in enumerate(server.shard_paths()):
+        conn = sqlite3.connect(path)
+        counts = []
+        for table in server.USER_TABLES:
+            try:
+                counts.append(f"{table}={conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]}")
+            except sqlite3.OperationalError:
+                counts.append(f"{table}=-")
+        conn.close()
+        size = os.path.getsize(path) / 1e6 if os.path.exists(path) else 0
+        print(f"shard {i}: {path} ({size:.1f} MB) " + " ".join(counts))
+    conn = sqlite3.connect(server.DB_PATH)
+    states = dict(conn.execute("SELECT state, COUNT(*) FROM transfers GROUP BY state").fetchall())
+    conn.close()
+    print(f"transfers: {states}")
+
+
+def open_transfers():
+    conn = sqlite3.connect(server.DB_PATH)
+    n = conn.execute("SELECT COUNT(*) FROM transfers WHERE state IN ('reserved','debited')").fetchone()[0]
+    conn.close()
+    return n
+
+
+def reshard(new_n, log=print):
+    old_n = server.DB_SHARDS
+    if new_n < 1:
+        raise SystemExit("--to must be >= 1")
+    if new_n == old_n:
+        log(f"already at {old_n} shard(s)")
+        return
+
+    # App is stopped, nothing is in flight: every open transfer is stuck.
+    log(f"recover: {server.recover_transfers(min_age=0)}")
+    if open_transfers():
+        raise SystemExit("open transfers remain, refusing to reshard")
+
+    old_paths = list(server.shard_paths(old_n))
+    new_paths = list(server.shard_paths(new_n))
+    base, ext = os.path.splitext(server.DB_PATH)
+    staging = [f"{base}.reshard{i}{ext}" for i in range(new_n)]
+    ddl = table_ddl(old_paths[0])
+    # the user_rev triggers would renumber revs of the copied rows: created after the copy
+    triggers = [sql for type_, _, _, sql in ddl if type_ == "trigger"]
+    ddl = [row for row in ddl if row[0] != "trigger"]
+    version = server.schema_version(old_paths[0])
+
+    t0 = time.perf_counter()
+    dst = []
+    for path in staging:
+        if os.path.exists(path):
+            os.remove(path)
+        conn = sqlite3.connect(path, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        for _, _, _, sql in ddl:
+            conn.execute(sql)
+        conn.execute(f"PRAGMA user_version={version}")  # same schema as the source, nothing to migrate
+        conn.execute("BEGIN")
+        dst.append(conn)
+
+    for table in server.USER_TABLES:
+        moved = 0
+        for path in old_paths:
+            src = sqlite3.connect(path)
+            # tx_log ids are per-file AUTOINCREMENT and would collide once merged;
+            # rows are copied in id order so each user's history keeps its order.
+            cols = [c for c in table_columns(src, table) if not (table == "tx_log" and c == "id")]
+            uid_idx = cols.index("user_id")
+            insert = f"INSERT INTO {table}({','.join(cols)}) VALUES({','.join('?' * len(cols))})"
+            cur = src.execute(f"SELECT {','.join(cols)} FROM {table} ORDER BY rowid")
+            while True:
+                rows = cur.fetchmany(BATCH)
+                if not rows:
+                    break
+                routed = [[] for _ in dst]
+                for row in rows:
+                    routed[server.shard_index(row[uid_idx], new_n)].append(row)
+                for conn, chunk in zip(dst, routed):
+                    if chunk:
+                        conn.executemany(insert, chunk)
+                moved += len(rows)
+            src.close()
+        log(f"{table:<16} {moved:>10} rows")
+
+    for conn in dst:
+        for sql in triggers:
+            conn.execute(sql)
+        conn.execute("COMMIT")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.close()
+
+    if new_n == 1:
+        # single shard == the main file: swap the per-user tables in place
+        conn = sqlite3.connect(server.DB_PATH, isolation_level=None)
+        conn.execute("ATTACH DATABASE ? AS staged", (staging[0],))
+        conn.execute("BEGIN")
+        for table in server.USER_TABLES:
+            conn.execute(f"DROP TABLE IF EXISTS main.{table}")
+        for _, _, _, sql in ddl:
+            conn.execute(sql)
+        for table in server.USER_TABLES:
+            conn.execute(f"INSERT INTO main.{table} SELECT * FROM staged.{table}")
+        for sql in triggers:
+            conn.execute(sql)
+        conn.execute("COMMIT")
+        conn.execute("DETACH DATABASE staged")
+        conn.close()
+        remove_db_file(staging[0])
+    else:
+        for src, dst_path in zip(staging, new_paths):
+            # a leftover -wal of the old file would be replayed onto the new one
+            for suffix in ("-wal", "-shm", "-journal"):
+                if os.path.exists(dst_path + suffix):
+                    os.remove(dst_path + suffix)
+            os.replace(src, dst_path)
+
+    for path in old_paths:
+        if path == server.DB_PATH:
+            if new_n > 1:
+                conn = sqlite3.connect(path, isolation_level=None)
+                for table in server.USER_TABLES:
+                    conn.execute(f"DROP TABLE IF EXISTS {table}")
+                conn.execute("VACUUM")
+                conn.close()
+        elif path not in new_paths:
+            remove_db_file(path)
+
+    log(f"resharded {old_n} -> {new_n} in {time.perf_counter() - t0:.1f}s; restart the app with DB_SHARDS={new_n}")
+
+
+def remove_db_file(path):
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("status")
+    rec = sub.add_parser("recover")
+    rec.add_argument("--min-age", type=int, default=60, help="only transfers idle this many seconds")
+    rs = sub.add_parser("reshard")
+    rs.add_argument("--to", type=int, required=True, help="new shard count")
+    args = ap.parse_args(argv)
+
+    if args.cmd == "status":
+        status()
+    elif args.cmd == "recover":
+        print(server.recover_transfers(min_age=args.min_age))
+    elif args.cmd == "reshard":
+        reshard(args.to)
+
+
+if __name__ == "__main__":
+    main()
@@ -43,7 +43,7 @@ function renderCard(p, mode = "my") {
 
     return `<div class="player-card ${p.rarity || "common"}">
         <h3>${p.name}</h3>
-        <img src="/web/images/players/${p.image}" class="player-image" alt="${p.name}" onerror="this.onerror=null;this.src='${FALLBACK_PLAYER_IMAGE}';">
+        <img src="${p.image_url || `/web/images/players/${p.image}`}" class="player-image" alt="${p.name}" onerror="this.onerror=null;this.src='${FALLBACK_PLAYER_IMAGE}';">
         <p class="meta">${p.position}</p>
         <p>ATT:${p.attack} DEF:${p.defense} SPD:${p.speed}</p>
         <p class="meta">Сила: ${total}</p>